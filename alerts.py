@@ -0,0 +1,150 @@
+# encoding=utf-8
+
+from collections import OrderedDict
+import threading
+
+import numpy as np
+import pandas as pd
+
+from datastore import to_stamps
+
+RATE_WINDOW = 1800  # sec, time constant of the rolling consumption rate.
+MAX_GAP = 3600  # sec, longer gaps between samples, e.g. nights, do not update rates.
+MAX_CHECKPOINTS = 48  # Hourly checkpoints kept by a forecaster.
+LOW_TANK_RATIO = 0.2  # A tank below this ratio of its capacity raises an alert.
+HOUR_NS = 3600 * 10**9
+
+
+class DepletionForecaster:
+    """ Rolling consumption rates of machine tanks, for forecasting when
+    they run empty.
+
+    Each machine keeps the level and time of its last sample, and per tank
+    an exponentially weighted rate of consumption, so a new sample is O(1):
+
+        rate += (1 - exp(-dt / window)) * ((last level - level) / dt - rate)
+
+    A level that rises is a refill, which resets the level and keeps the
+    rate. Machines are rows of arrays, and samples of the same time are
+    applied to all their machines at once, so a minute of thousands of
+    machines is a few array operations.
+
+    After the samples of a whole hour (e.g. 15:00:00), a copy of the arrays
+    is kept as the checkpoint of (day, hour), which views of that hour read.
+    """
+
+    def __init__(self, tanks, window=RATE_WINDOW, max_gap=MAX_GAP, max_checkpoints=MAX_CHECKPOINTS):
+        self.tanks = list(tanks)
+        self.window = window
+        self.max_gap = max_gap
+        self.max_checkpoints = max_checkpoints
+        self.index = dict()  # {mach_num: row}
+        self.machines = []
+        self.levels = np.zeros((0, len(self.tanks)), dtype=np.float64)
+        self.rates = np.zeros_like(self.levels)  # per sec
+        self.times = np.zeros(0, dtype=np.int64)  # ns, 0 before the first sample
+        self.checkpoints = OrderedDict()  # {(day, hour): checkpoint}
+        self.samples = 0
+        self.latest = 0  # ns of the latest sample
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.machines)
+
+    def get_rows(self, mach_nums):
+        """ Return the rows of machines, adding rows for new ones. """
+        codes, labels = pd.factorize(np.asarray(mach_nums))
+        new = [m for m in labels if m not in self.index]
+        if new:
+            for mach_num in new:
+                self.index[mach_num] = len(self.machines)
+                self.machines.append(mach_num)
+            self.levels = np.concatenate([self.levels, np.zeros((len(new), len(self.tanks)))])
+            self.rates = np.concatenate([self.rates, np.zeros((len(new), len(self.tanks)))])
+            self.times = np.concatenate([self.times, np.zeros(len(new), dtype=np.int64)])
+        return np.array([self.index[m] for m in labels], dtype=np.int64)[codes]
+
+    def update(self, df):
+        """ Apply state rows of any machines, which are in order of datetime
+        for each machine, e.g. new rows of machine_state. """
+        if df is None or not len(df):
+            return
+        stamps = to_stamps(df['datetime'])
+        order = np.argsort(stamps, kind='mergesort')
+        stamps = stamps[order]
+        levels = df[self.tanks].to_numpy(dtype=np.float64)[order]
+        with self._lock:
+            rows = self.get_rows(df['mach_num'].to_numpy())[order]
+            edges = np.flatnonzero(stamps[1:] != stamps[:-1]) + 1
+            for start, stop in zip(np.concatenate(([0], edges)), np.concatenate((edges, [len(stamps)]))):
+                self.apply(stamps[start], rows[start:stop], levels[start:stop])
+            self.samples += len(stamps)
+
+    def apply(self, stamp, rows, levels):
+        """ Apply samples of one time to machine rows. Samples not after the
+        last one of a machine, e.g. rows read again, are skipped. """
+        newer = self.times[rows] < stamp
+        rows, levels = rows[newer], levels[newer]
+        seen = self.times[rows] > 0
+        dt = (stamp - self.times[rows]) / 1e9
+        # Rates follow machines seen recently, and tanks that did not rise.
+        ok = seen & (dt > 0) & (dt <= self.max_gap)
+        if ok.any():
+            r, d = rows[ok], dt[ok][:, None]
+            used = self.levels[r] - levels[ok]
+            weight = np.where(used >= 0, 1 - np.exp(-d / self.window), 0.)
+            self.rates[r] += weight * (used / d - self.rates[r])
+        self.levels[rows] = levels
+        self.times[rows] = stamp
+        self.latest = max(self.latest, stamp)
+        if stamp % HOUR_NS == 0:
+            moment = pd.Timestamp(stamp)
+            self.checkpoints[(moment.date(), moment.hour)] = self.checkpoint()
+            while len(self.checkpoints) > self.max_checkpoints:
+                self.checkpoints.popitem(last=False)
+
+    def checkpoint(self):
+        """ Return a copy of the arrays, see get_alerts. """
+        return {'tanks': self.tanks, 'index': dict(self.index), 'machines': list(self.machines),
+                'levels': self.levels.copy(), 'rates': self.rates.copy(), 'times': self.times.copy()}
+
+    def get_checkpoint(self, day, hour):
+        """ Return the checkpoint of day at the hour, or of its last hour
+        before, or None. The hour of the latest sample, and later hours of
+        its day, get the current arrays. """
+        with self._lock:
+            latest = pd.Timestamp(self.latest)
+            if self.latest and latest.date() == day and latest.hour <= hour:
+                return self.checkpoint()
+            found = [(h, c) for (d, h), c in self.checkpoints.items() if d == day and h <= hour]
+        return max(found, key=lambda item: item[0])[1] if found else None
+
+
+def get_alerts(checkpoint, until, capacity, machines=None, low_ratio=LOW_TANK_RATIO):
+    """ Return a list of (mach_num, tank, ratio, empty_at) of tanks which
+    are low or run empty before until, soonest first. empty_at is a
+    Timestamp, or None for a low tank that is not being used.
+
+    :param capacity: a dict of {tank: capacity}.
+    :param machines: machine numbers to check, all machines without it.
+    """
+    if checkpoint is None:
+        return []
+    index = checkpoint['index']
+    rows = np.arange(len(checkpoint['machines'])) if machines is None else \
+        np.array([index[m] for m in machines if m in index], dtype=np.int64)
+    rows = rows[checkpoint['times'][rows] > 0]
+    levels, rates = checkpoint['levels'][rows], checkpoint['rates'][rows]
+    ratios = levels / np.array([capacity[tank] for tank in checkpoint['tanks']], dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seconds = np.where(rates > 0, np.maximum(levels, 0) / rates, np.inf)
+    empty_at = checkpoint['times'][rows][:, None] / 1e9 + seconds
+    limit = pd.Timestamp(until).value / 1e9
+    i, t = np.nonzero((empty_at < limit) | (ratios < low_ratio))
+    empty_at, ratios = empty_at[i, t], ratios[i, t]
+    finite = np.isfinite(empty_at)
+    minutes = np.where(finite, empty_at // 60, np.iinfo(np.int64).max).astype(np.int64)
+    order = np.lexsort((ratios, minutes))
+    whens = pd.to_datetime(np.where(finite, minutes, 0)[order] * 60, unit='s')
+    return [(checkpoint['machines'][rows[i[k]]], checkpoint['tanks'][t[k]], float(ratios[k]),
+             when if finite[k] else None) for k, when in zip(order, whens)]
@@ -9,16 +9,30 @@ try:
     import numpy as np
     import pandas as pd
     # extend lib: dash
+    import flask
     import dash
     import dash_core_components as dcc
     import dash_html_components as html
     import dash_daq as daq
-    from dash.dependencies import Input, Output, State
+    from dash.dependencies import Input, Output, State, ClientsideFunction
     from dash.exceptions import PreventUpdate
     import plotly.express as px
     # local lib
     from coffeemachine import Menu
+    from datastore import MachineStore, split_by_machine
+    from schema import prepare_table, union_categories
+    from ingest import TailIngestor, INGEST_INTERVAL
+    from rollup import SalesRollup, SALES_TARGET
+    from cache import LRUCache
+    from history import get_state_history
+    from fleet import summarize_fleet
+    from alerts import DepletionForecaster, get_alerts, LOW_TANK_RATIO
+    from broker import Broker, format_event
+    from metrics import CallbackMetrics
+    from statelog import StateEngine
+    from report import iter_reports, REPORTS
     import connector
+    import snapshot
 except ImportError as err:
     print(err)
     sys.exit(2)
@@ -27,10 +41,40 @@ except ImportError as err:
 # Global variables and constants
 # -------------------------------------------------------------------------------
 APP_PATH = os.path.dirname(os.path.abspath(__file__))
-UPDATE_INTERVAL = 2  # sec
+UPDATE_INTERVAL = 1  # sec, the clock moves UPDATE_INTERVAL x replay speed each time.
+REPLAY_SPEEDS = [1, 10, 100, 300]  # Pseudo seconds per second, see assets/clientside.js.
+REPLAY_SPEED = 300  # 10 minutes per 2 seconds.
+LIVE_INTERVAL = 1  # sec, how often the browser applies pushed events, no request is made.
+EVENTS_PATH = '/events/'  # Server-sent events of a machine, EVENTS_PATH + mach_num.
+# Open event streams of a worker, each holds a thread of it (see Procfile), so
+# the other threads are left for callbacks. Pages refused a stream poll instead.
+MAX_EVENT_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', 16))
+POLL_INTERVAL = 10  # sec, how often a page without an event stream polls the machine status.
+REPORTS_PATH = '/reports/'  # Daily reports as CSV, e.g. /reports/shop_daily.csv?start=2021-01-01&shop=Shop 000
+VIEW_CACHE_SIZE = 512  # (view, machine, day, hour) entries, a sales view is about 20 KB.
+# Bytes of the entries, estimated by cache.estimate_size. Fleet views and alert
+# replays grow with the fleet, so the count alone does not bound the memory.
+VIEW_CACHE_BYTES = int(os.environ.get('VIEW_CACHE_BYTES', 256 * 2 ** 20))
+SNAPSHOT_INTERVAL = 3600  # sec
+TABLES = {'order': 'machine_order', 'state': 'machine_state'}
+# 'table' reads every state row from machine_state. 'events' keeps only its
+# snapshots, e.g. one per hour, and rebuilds the states between them from
+# orders and refills, see statelog.StateEngine.
+STATE_SOURCE = os.environ.get('STATE_SOURCE', 'table')
+if STATE_SOURCE == 'events':
+    TABLES['refill'] = 'machine_refill'
+METRICS_PATH = '/metrics'
+# Print callbacks slower than this (sec), e.g. SLOW_CALLBACK_SEC=0.5, unset to disable.
+SLOW_CALLBACK_SEC = float(os.environ['SLOW_CALLBACK_SEC']) if os.environ.get('SLOW_CALLBACK_SEC') else None
 today = date(2021, 1, 1)
 business_hour = {'open': time(9, 0, 0), 'close': time(21, 0, 0)}
 menu = Menu()
+STATE_COLUMNS = ['tank_water', 'tank_milk', 'tank_beans', 'barometer', 'thermometer']
+TANK_COLUMNS = STATE_COLUMNS[:3]
+TANK_CAPACITY = {'tank_water': 1600, 'tank_milk': 1200, 'tank_beans': 1000}  # Same as max of tanks.
+TOP_MACHINES = 5  # Machines listed by revenue in the fleet overview.
+TOP_ALERTS = 20  # Tank alerts listed in the fleet overview, soonest to run empty first.
+HOURLY_TIER_DAYS = 7  # Longer date ranges show daily sales instead of hourly.
 
 
 # -------------------------------------------------------------------------------
@@ -45,27 +89,167 @@ def join_paths(paths):
 
 
 def init_coffee_machine_data():
-    result = dict()
-    for key, table in [('order', 'machine_order'), ('state', 'machine_state')]:
-        # df = connector.read_from_sqlite(table)
-        df = connector.read_from_postgres(table)
-        df['datetime'] = pd.to_datetime(df['date'] + ' ' + df['time'])
-        df = df.drop(['date', 'time'], axis=1)
-        result[key] = df
+    """ Return a dict of table dataframes read from database. Tables, and
+    date-range shards of them, are read and parsed concurrently. """
+    result = connector.read_tables(TABLES, transform=prepare_table,
+                                   concat=lambda frames: pd.concat(union_categories(frames), ignore_index=True))
+    failed = [TABLES[key] for key, df in result.items() if df is None]
+    if failed:
+        raise IOError(f"Fail to read {', '.join(failed)}.")
     return result
 
 
-coffee_machine_data = init_coffee_machine_data()
+def sort_tables(data):
+    """ Return tables sorted by (mach_num, datetime), the order of
+    MachineStore, so stores of a loaded snapshot keep its mapped columns
+    instead of sorted copies. Sorted tables are used as they are. """
+    return {key: split_by_machine(df)[0] for key, df in data.items()}
+
+
+def load_coffee_machine_data():
+    """ Return (data, meta) from the local snapshot, which loads fast and is
+    memory-mapped, so workers share its pages. If there is no snapshot yet,
+    read database and save one. """
+    data, meta = snapshot.load_snapshot()
+    if data is None:
+        snapshot.save_snapshot(sort_tables(init_coffee_machine_data()))
+        data, meta = snapshot.load_snapshot()
+    return data, meta
+
+
+def build_data_indexes(data, version=0):
+    """ Return the machine stores, sales rollup and state engine of data.
+    The state engine is None unless STATE_SOURCE=events. """
+    # Each table is indexed by machine and datetime, see datastore.MachineStore.
+    stores = {key: MachineStore(df, version=version) for key, df in data.items()}
+    engine = StateEngine(stores['state'], stores['order'], stores['refill'], STATE_COLUMNS, menu, business_hour) \
+        if STATE_SOURCE == 'events' else None
+    return stores, SalesRollup(menu, stores['order'].df), engine
+
+
+def get_state_store():
+    """ Return what machine states are read from, the state table or the
+    state engine, which both read like a MachineStore. """
+    return state_engine if STATE_SOURCE == 'events' else machine_stores['state']
+
+
+def read_day_states(day):
+    """ Return state rows of every machine on day. """
+    store = get_state_store()
+    frames = [store.read(mach_num, datetime.combine(day, business_hour['open']),
+                         datetime.combine(day, business_hour['close']))
+              for mach_num in machine_stores['state'].machines()]
+    return pd.concat(union_categories(frames), ignore_index=True) if frames else store.empty()
+
+
+def get_new_states(key, df, machines):
+    """ Return the state rows which new rows of table key make. With
+    STATE_SOURCE=events, orders and refills change the rebuilt states of
+    their machines after them, and new state rows are snapshots of those. """
+    if STATE_SOURCE != 'events':
+        return df if key == 'state' else machine_stores['state'].empty()
+    if key == 'state' or not machines:
+        return state_engine.empty()
+    bounds = df.groupby('mach_num', observed=True)['datetime'].agg(['min', 'max'])
+    frames = [state_engine.read(mach_num, start, end + state_engine.tick)
+              for mach_num, (start, end) in bounds.iterrows()]
+    return pd.concat(union_categories(frames), ignore_index=True)
+
+
+def ingest_rows(key, df):
+    """ Append new rows to the machine store, and the indexes derived from it,
+    then update tank forecasts and push them to pages of the machines. """
+    machines = machine_stores[key].append(df)
+    if key == 'order':
+        sales_rollup.add(df)
+    if key == 'state' or STATE_SOURCE == 'events':
+        # Orders and refills change rebuilt states too, see statelog.StateEngine.
+        for day in df['datetime'].dt.date.unique():
+            day_versions[day] = day_versions.get(day, 0) + 1
+    states = get_new_states(key, df, machines)
+    forecaster.update(states)
+    # Views of the machines are outdated, their keys have the old version.
+    changed = set(machines)
+    view_cache.invalidate(lambda view_key: view_key[1] in changed)
+    publish_rows(key, machines, states)
+
+
+def get_watermark_rows(store):
+    """ Return the rows of a store at its latest datetime, or None, which
+    the ingestor does not hand on again. """
+    if store.latest is None:
+        return None
+    end = store.latest.to_datetime64() + np.timedelta64(1, 'ns')
+    return pd.concat(union_categories([store.read(mach_num, store.latest, end) for mach_num in store.machines()]),
+                     ignore_index=True)
+
+
+def remap_coffee_machine_data():
+    """ Swap in the current snapshot, which another worker may have saved,
+    and re-read rows after it. Rows ingested before are dropped from private
+    memory, as the snapshot holds them in shared pages. """
+    global machine_stores, sales_rollup, state_engine
+    data, meta = snapshot.load_snapshot()
+    if data is None:
+        return
+    version = max(store.version for store in machine_stores.values()) + 1
+    machine_stores, sales_rollup, state_engine = build_data_indexes(data, version)
+    for key, store in machine_stores.items():
+        ingestor.set_watermark(key, store.latest, get_watermark_rows(store))
+    data_status['snapshot'] = meta['created']
+    data_status['version'] = meta['version']
+
+
+def on_ingest_poll(counts):
+    """ Record the refresh time, save a snapshot of new rows now and then,
+    and swap in a snapshot newer than the one in use. """
+    now = datetime.now()
+    data_status['refreshed'] = now
+    saved = data_status['saved']
+    if any(counts.values()) and (saved is None or (now - saved).total_seconds() > SNAPSHOT_INTERVAL):
+        snapshot.save_snapshot(sort_tables({key: store.df for key, store in machine_stores.items()}))
+        data_status['saved'] = now
+    if snapshot.current_version() != data_status['version']:
+        remap_coffee_machine_data()
+    broker.publish('status', 'status', {'freshness': get_data_freshness()})
+
+
+_data, _meta = load_coffee_machine_data()
+machine_stores, sales_rollup, state_engine = build_data_indexes(_data)
+day_versions = dict()  # {day: changes of its machine states by ingested rows}, see get_day_version().
+data_status = {'snapshot': _meta['created'], 'version': _meta['version'], 'refreshed': None, 'saved': None}
+del _data, _meta
+# Pages subscribe to machines, and get new rows pushed, see stream_machine_events().
+broker = Broker()
+# Tank forecasts, from the states of the latest day on, see get_alert_checkpoint().
+forecaster = DepletionForecaster(TANK_COLUMNS)
+if machine_stores['state'].latest is not None:
+    forecaster.update(read_day_states(machine_stores['state'].latest.date()))
+# Workers serve the snapshot, while new rows are read in background.
+ingestor = TailIngestor(TABLES, ingest_rows,
+                        watermarks={key: store.latest for key, store in machine_stores.items()},
+                        watermark_rows={key: get_watermark_rows(store) for key, store in machine_stores.items()})
+ingestor.start(INGEST_INTERVAL, on_poll=on_ingest_poll)
+
+
+def get_data_freshness():
+    """ Return a text about how fresh the data is. """
+    latest = max((store.latest for store in machine_stores.values() if store.latest is not None),
+                 default=None)
+    latest = 'no data' if latest is None else latest.strftime('%Y-%m-%d %H:%M')
+    if data_status['refreshed'] is None:
+        return f"Data until {latest} (snapshot {data_status['snapshot']}, refreshing...)"
+    return f"Data until {latest} (refreshed {data_status['refreshed'].strftime('%Y-%m-%d %H:%M')})"
 
 
 def read_machine_df(key, mach_num, start_dt, end_dt):
-    if key not in list(coffee_machine_data):
+    if key not in list(machine_stores):
         raise KeyError(f"No dataframe named {key} in coffee-machine-data.")
 
-    df = coffee_machine_data[key]
+    store = get_state_store() if key == 'state' else machine_stores[key]
+    df = store.empty()
     if mach_num:
-        mask = (df['mach_num'] == mach_num) & (df['datetime'] >= start_dt) & (df['datetime'] < end_dt)
-        return df.loc[mask]
+        return store.read(mach_num, start_dt, end_dt)
     # Default dataframes.
     if key == 'state':
         return pd.DataFrame(columns=df.columns, data=[['2021-01-01', '00:00:00', 0, 0, 0, 0, 0, 0, 0]])
@@ -73,10 +257,116 @@ def read_machine_df(key, mach_num, start_dt, end_dt):
         return pd.DataFrame(columns=df.columns, data=[['2021-01-01', '00:00:00', '', '', '']])
 
 
+# Callback outputs shared by sessions of the same machine, see get_replay_frames().
+view_cache = LRUCache(maxsize=VIEW_CACHE_SIZE, maxbytes=VIEW_CACHE_BYTES)
+
+
+def to_state_series(df, day):
+    """ Return state rows of df as compact arrays, which are 'seconds' of
+    the day and a list of values of each of STATE_COLUMNS. """
+    seconds = (df['datetime'] - pd.Timestamp(day)).dt.total_seconds().astype(np.int64)
+    values = [df[col].to_numpy() for col in STATE_COLUMNS]
+    values = [(np.round(i.astype(np.float64), 2) if i.dtype.kind == 'f' else i).tolist() for i in values]
+    return {'columns': STATE_COLUMNS, 'seconds': seconds.tolist(), 'values': values}
+
+
+def get_state_series(mach_num, day):
+    """ Return the states of a machine on day, see to_state_series. """
+    version = get_state_store().machine_version(mach_num)
+
+    def build():
+        df = read_machine_df('state', mach_num, datetime.combine(day, business_hour['open']),
+                             datetime.combine(day, business_hour['close']))
+        return dict(to_state_series(df, day), mach_num=mach_num, day=day.isoformat(), version=version)
+
+    return view_cache.get_or_put(('state', mach_num, day, None, version), build)
+
+
+def publish_rows(key, machines, states):
+    """ Push new rows of the machines to their subscribers: a new version of
+    orders, which makes the page refresh sales, and the states of each day. """
+    topics = broker.topics()
+    for mach_num in machines:
+        if mach_num not in topics:
+            continue
+        if key == 'order':
+            broker.publish(mach_num, 'order', {'mach_num': mach_num,
+                                               'version': machine_stores[key].machine_version(mach_num)})
+        rows = states[states['mach_num'] == mach_num].sort_values('datetime')
+        for day, day_rows in rows.groupby(rows['datetime'].dt.date):
+            series = to_state_series(day_rows, day)
+            broker.publish(mach_num, 'state', dict(series, mach_num=mach_num, day=day.isoformat()))
+
+
+def stream_machine_events(mach_num):
+    """ Return a response of server-sent events of a machine and data status,
+    which starts with the current status. When MAX_EVENT_STREAMS are open,
+    return 503, and the page polls get_machine_status instead. """
+    subscription = broker.open([mach_num, 'status'], MAX_EVENT_STREAMS)
+    if subscription is None:
+        return flask.Response('Too many event streams, poll the status instead.', status=503,
+                              headers={'Retry-After': str(POLL_INTERVAL)})
+    initial = format_event('status', {'freshness': get_data_freshness()})
+    response = flask.Response(flask.stream_with_context(broker.stream(subscription, initial=[initial])),
+                              mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                     'X-Accel-Buffering': 'no'})
+    # A stream that never starts, e.g. the client left at once, is closed here.
+    response.call_on_close(lambda: broker.close(subscription))
+    return response
+
+
+def get_machine_status(mach_num):
+    """ Return a JSON response of the order version of a machine and the data
+    status, like the events of a stream, for pages polling without one. """
+    return flask.jsonify({'order': {'mach_num': mach_num, 'version': machine_stores['order'].machine_version(mach_num)},
+                          'freshness': get_data_freshness()})
+
+
+def stream_report(name):
+    """ Return a CSV response of a report of report.py, which is written a
+    shop at a time from the machine stores. Query arguments are 'start' and
+    'end' days, the month of the last day of data by default, and 'shop',
+    which may repeat, all shops by default. """
+    if name not in REPORTS:
+        flask.abort(404)
+    args = flask.request.args
+    try:
+        end_day = parse_date(args.get('end'), get_date_range()[1])
+        start_day = parse_date(args.get('start'), end_day.replace(day=1))
+    except ValueError as err:
+        flask.abort(400, str(err))
+    shops = {shop: mach_in_shop.get(shop, []) for shop in args.getlist('shop') or SHOP_NAMES}
+
+    def generate():
+        header = True
+        for _, reports in iter_reports(machine_stores['order'], machine_stores.get('refill'), shops,
+                                       start_day, end_day, menu):
+            if len(reports[name]):
+                yield reports[name].to_csv(index=False, header=header)
+                header = False
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='text/csv',
+                          headers={'Content-Disposition': f'attachment; filename={name}.csv'})
+
+
+def get_date_range():
+    """ Return the first and last day of the data. """
+    latest = machine_stores['order'].latest
+    earliest = machine_stores['order'].df['datetime'].min()
+    if latest is None or pd.isna(earliest):
+        return today, today
+    return earliest.date(), latest.date()
+
+
+def parse_date(value, default=None):
+    """ Return the date of a DatePickerRange value, e.g. '2021-01-01'. """
+    return date.fromisoformat(value[:10]) if value else default
+
+
 def create_machine_options():
     """ Return a dict of machines, use shop name as key to get machines belong to it. """
     result = {None: []}
-    df = coffee_machine_data['order']
+    df = machine_stores['order'].df
     for shop in df['shop'].unique():
         machines = list(df[df['shop'] == shop]['mach_num'].unique())
         result[shop] = machines
@@ -90,8 +380,10 @@ def reform_options(options):
     return [{'label': i, 'value': i} for i in options]
 
 
+DATE_RANGE = get_date_range()
 mach_in_shop = create_machine_options()  # Use 'None' as key will return all machines.
-SHOP_OPTIONS = reform_options([i for i in mach_in_shop if i is not None])
+SHOP_NAMES = [i for i in mach_in_shop if i is not None]
+SHOP_OPTIONS = reform_options(SHOP_NAMES)
 MACHINE_OPTIONS = {shop: reform_options(mach_in_shop[shop]) for shop in list(mach_in_shop)}
 
 
@@ -109,8 +401,27 @@ def build_internal_content():
             interval=UPDATE_INTERVAL * 1000,
             n_intervals=0,
         ),
-        dcc.Store(id='mach-order-data', storage_type='session'),
-        dcc.Store(id='mach-state-data', storage_type='session')
+        # Applies pushed events in browser, see assets/clientside.js.
+        dcc.Interval(
+            id='live-interval',
+            interval=LIVE_INTERVAL * 1000,
+            n_intervals=0,
+        ),
+        dcc.Store(id='live-path', data={'path': EVENTS_PATH, 'poll_interval': POLL_INTERVAL}),
+        dcc.Store(id='live-machine', storage_type='memory'),
+        dcc.Store(id='mach-order-live', storage_type='memory'),
+        dcc.Store(id='mach-state-live', storage_type='memory'),
+        # The day of the machine, played by clock, see get_replay_frames().
+        dcc.Store(id='replay-frames', storage_type='memory'),
+        dcc.Store(id='clock-config', data={
+            'open': business_hour['open'].hour * 3600,
+            'close': business_hour['close'].hour * 3600,
+            'interval': UPDATE_INTERVAL
+        }),
+        # What the sales figures show, so updates can append to them.
+        dcc.Store(id='fig-sales-shown', storage_type='memory'),
+        # Hour of the clock, changes once an hour.
+        dcc.Store(id='clock-hour', storage_type='memory')
     ], id='internal-content')
 
 
@@ -133,7 +444,17 @@ def build_filter():
                 html.Button('<', id='mach-prev-btn'),
                 html.Button('>', id='mach-next-btn')
             ], className='mach-flt-btns')
-        ], className='navbar-1-item dir-row')
+        ], className='navbar-1-item dir-row'),
+        html.Div(
+            # The end date is the day shown on the clock, the range is shown as history.
+            dcc.DatePickerRange(
+                id='date-range',
+                min_date_allowed=DATE_RANGE[0],
+                max_date_allowed=DATE_RANGE[1],
+                start_date=today,
+                end_date=today,
+                display_format='YYYY-MM-DD'
+            ), className='navbar-1-item')
     ], className='navbar-1')
 
 
@@ -142,7 +463,13 @@ def build_clock():
     (Apply in demonstration only) """
     return html.Div([
         daq.LEDDisplay(id='clock', value='00:00:00',
-                       size=24, color='#333333')
+                       size=24, color='#333333'),
+        dcc.RadioItems(
+            id='replay-speed',
+            options=[{'label': f'{speed}x', 'value': speed} for speed in REPLAY_SPEEDS],
+            value=REPLAY_SPEED,
+            labelStyle={'display': 'inline-block'}
+        )
     ], className='navbar-2')
 
 
@@ -168,16 +495,15 @@ def get_sales_df(df=None, period=(9, 21)):
             df = pd.concat([df, dff])
         return df
 
-    df['time_period'] = df['datetime'].apply(lambda t: t.hour)
+    df['time_period'] = df['datetime'].dt.hour
     dff = df.drop(['mach_num', 'shop'], axis=1)
     dff = dff.groupby(['time_period', 'flavor']).count()
     dff = dff.rename(columns={'datetime': 'amount'}).reset_index()
     # Except rows in given period, set amount to 0.
     mask = (dff['time_period'] >= period[0]) & (dff['time_period'] < period[1])
     dff.loc[~mask, 'amount'] = 0
-    for choice in menu.Choices:
-        mask = dff['flavor'] == choice.value
-        dff.loc[mask, ['sales']] = dff['amount'] * menu.cost[choice]
+    prices = {choice.value: menu.cost[choice] for choice in menu.Choices}
+    dff['sales'] = dff['amount'] * dff['flavor'].map(prices).astype(np.int64)
     return dff.loc[dff['time_period'] < period[1]]
 
 
@@ -207,10 +533,10 @@ def get_sales_perf_graph(df, cum=True):
     fig.update_yaxes(showgrid=True)
     fig.update_traces(mode='markers+lines')
     # Add text and line for sales target
-    fig.add_annotation(text='Target', x=range_x[1], y=3000, showarrow=False, bgcolor='salmon')
+    fig.add_annotation(text='Target', x=range_x[1], y=SALES_TARGET, showarrow=False, bgcolor='salmon')
     fig.add_shape(
         type='line', line_color='salmon', line_width=3, opacity=1, line_dash='dot',
-        x0=range_x[0], x1=range_x[1], y0=3000, y1=3000
+        x0=range_x[0], x1=range_x[1], y0=SALES_TARGET, y1=SALES_TARGET
     )
     # Add text and line for shop's open and close time
     fig.add_annotation(text='Open', x=business_hour['open'].hour, y=range_y[1], showarrow=False)
@@ -233,6 +559,177 @@ dcc_graphs = {
                             figure=get_sales_perf_graph(get_sales_df()))
 }
 
+
+def get_sales_series(mach_num, day, period):
+    """ Return hours of period, the (hour x flavor) order counts and the
+    cumulative sales of each hour, as the sales figures show them. """
+    hours = list(range(*period))
+    counts = sales_rollup.get_counts(mach_num, day, period)
+    sales = sales_rollup.get_revenue(mach_num, day, period).sum(axis=1)
+    sales = np.where(sales > 0, np.cumsum(sales), 0)  # Same as get_sales_perf_graph(cum=True).
+    return hours, counts, sales
+
+
+def get_replay_frames(mach_num, day):
+    """ Return all the machine section shows of a machine on day, which the
+    browser plays at any clock and speed without a request: 'hours' of the
+    business hour, their (hour x flavor) 'counts' and cumulative 'sales',
+    and 'states' of every tick, see get_state_series. Shared by sessions. """
+    version = (machine_stores['order'].machine_version(mach_num), get_state_store().machine_version(mach_num))
+
+    def build():
+        hours, counts, sales = get_sales_series(mach_num, day, (business_hour['open'].hour,
+                                                                business_hour['close'].hour))
+        return {'mach_num': mach_num, 'day': day.isoformat(), 'version': version, 'hours': hours,
+                'counts': counts.tolist(), 'sales': sales.tolist(), 'states': get_state_series(mach_num, day)}
+
+    return view_cache.get_or_put(('replay', mach_num, day, None, version), build)
+
+
+def get_sales_history_graph(mach_num, start_day, end_day):
+    """ Return a figure of flavor sales from start_day to end_day, of the
+    hourly tier for short ranges and the daily tier for long ones. """
+    if (end_day - start_day).days < HOURLY_TIER_DAYS:
+        times, counts, _ = sales_rollup.get_hourly(mach_num, start_day, end_day)
+        label = 'Hour'
+    else:
+        times, counts, _ = sales_rollup.get_daily(mach_num, start_day, end_day)
+        label = 'Day'
+    df = pd.DataFrame({
+        'time_period': np.repeat(times, counts.shape[1]),
+        'flavor': np.tile(sales_rollup.flavors, len(times)),
+        'amount': counts.ravel()
+    })
+    fig = px.bar(df, x='time_period', y='amount', color='flavor',
+                 labels={'time_period': label, 'amount': 'Amount', 'flavor': 'Flavors'},
+                 height=400, template='simple_white')
+    fig.update_layout(legend=dict(xanchor="left", x=0.9, yanchor="top", y=0.99), bargap=0)
+    return fig
+
+
+def get_tank_history_graph(mach_num, start_day, end_day):
+    """ Return a figure of tank levels from start_day to end_day, each tank
+    downsampled to MAX_POINTS points, see history.get_state_history. """
+    df = get_state_history(get_state_store(), mach_num, datetime.combine(start_day, time()),
+                           datetime.combine(end_day, time()) + pd.Timedelta(days=1), TANK_COLUMNS)
+    fig = px.line(df, x='datetime', y='value', color='column',
+                  labels={'datetime': 'Time', 'value': 'Level', 'column': 'Tanks'},
+                  height=400, template='simple_white')
+    fig.update_layout(legend=dict(xanchor="left", x=0.9, yanchor="top", y=0.99))
+    return fig
+
+
+def get_history_view(mach_num, start_day, end_day):
+    """ Return the history figures of a machine, shared by sessions. """
+    version = (machine_stores['order'].machine_version(mach_num), get_state_store().machine_version(mach_num))
+    return view_cache.get_or_put(
+        ('history', mach_num, (start_day, end_day), None, version),
+        lambda: (get_sales_history_graph(mach_num, start_day, end_day),
+                 get_tank_history_graph(mach_num, start_day, end_day)))
+
+
+def get_fleet_version():
+    """ Return a token that changes when rows of any machine change. """
+    return tuple((store.version, sum(store.versions.values())) for store in machine_stores.values())
+
+
+def get_day_version(day):
+    """ Return a token that changes when machine states of day change, by
+    ingested rows of that day or a reload of the stores. Rebuilt states of
+    STATE_SOURCE=events carry over, so there rows of earlier days count too. """
+    if STATE_SOURCE == 'events':
+        return machine_stores['state'].version, sum(count for i, count in day_versions.items() if i <= day)
+    return machine_stores['state'].version, day_versions.get(day, 0)
+
+
+def get_fleet_view(shops, day, hour):
+    """ Return the overview of machines in shops (all without shops) on day
+    until hour: the sales and flavor mix figures, the summary and the table
+    of tank alerts. Machines are summarized by fleet.summarize_fleet. """
+    shops = tuple(sorted(shops)) if shops else ()
+
+    def build():
+        machines = [m for shop in shops for m in mach_in_shop.get(shop, [])] if shops else mach_in_shop[None]
+        summary = summarize_fleet(sales_rollup, machines, day)
+        period = slice(business_hour['open'].hour, hour)
+        counts, revenue = summary['counts'][period], summary['revenue'][period]
+        hours = np.arange(period.start, period.stop)
+        df = pd.DataFrame({
+            'time_period': np.repeat(hours, counts.shape[1]),
+            'flavor': np.tile(sales_rollup.flavors, len(hours)),
+            'amount': counts.ravel()
+        })
+        fig_sales = px.bar(df, x='time_period', y='amount', color='flavor', range_x=[6, 24],
+                           labels={'time_period': 'Time Period', 'amount': 'Amount', 'flavor': 'Flavors'},
+                           height=400, template='simple_white')
+        fig_sales.update_layout(legend=dict(xanchor="left", x=0.9, yanchor="top", y=0.99))
+        fig_sales.update_xaxes(dtick=3, showgrid=True)
+        fig_mix = px.pie(names=sales_rollup.flavors, values=counts.sum(axis=0), height=400,
+                         template='simple_white')
+        top = sorted(summary['machine_revenue'].items(), key=lambda item: -item[1])[:TOP_MACHINES]
+        return {
+            'figures': (fig_sales, fig_mix),
+            'summary': {'machines': len(machines), 'cups': int(counts.sum()), 'revenue': int(revenue.sum()),
+                        'top': top},
+            'alerts': build_tank_alert_table(get_alerts(get_alert_checkpoint(day, hour),
+                                                        datetime.combine(day, business_hour['close']),
+                                                        TANK_CAPACITY, machines))
+        }
+
+    return view_cache.get_or_put(('fleet', shops, day, hour, get_fleet_version()), build)
+
+
+def build_fleet_summary(summary):
+    """ Return the components of the fleet summary. """
+    return [
+        html.P(f"{summary['machines']} machines, {summary['cups']} cups, revenue {summary['revenue']}"),
+        html.H5('Top machines'),
+        html.Ol([html.Li(f'{mach_num}: {revenue}') for mach_num, revenue in summary['top']])
+    ]
+
+
+def get_alert_checkpoint(day, hour):
+    """ Return the tank forecasts of day at hour, see alerts.DepletionForecaster.
+    The live forecaster has the latest hours, other days are replayed from
+    their states once and shared by sessions. """
+    checkpoint = forecaster.get_checkpoint(day, hour)
+    if checkpoint is not None:
+        return checkpoint
+
+    def build():
+        replay = DepletionForecaster(TANK_COLUMNS)
+        replay.update(read_day_states(day))
+        return replay
+
+    return view_cache.get_or_put(('alerts', None, day, None, get_day_version(day)), build).get_checkpoint(day, hour)
+
+
+def format_tank(tank):
+    return tank.replace('tank_', '').capitalize()
+
+
+def build_tank_alert_table(alerts, top=TOP_ALERTS):
+    """ Return a table of the top tank alerts, soonest to run empty first,
+    and how many more there are. """
+    if not alerts:
+        return html.P(f'No tank below {LOW_TANK_RATIO:.0%} or running empty before closing.')
+    table = html.Table([
+        html.Thead(html.Tr([html.Th('Machine'), html.Th('Tank'), html.Th('Level'), html.Th('Empty at')])),
+        html.Tbody([html.Tr([html.Td(mach_num), html.Td(format_tank(tank)), html.Td(f'{ratio:.0%}'),
+                             html.Td('-' if empty_at is None else empty_at.strftime('%H:%M'))])
+                    for mach_num, tank, ratio, empty_at in alerts[:top]])
+    ])
+    if len(alerts) <= top:
+        return table
+    return html.Div([table, html.P(f'{len(alerts) - top} more tank alerts.')])
+
+
+def build_tank_alerts(alerts):
+    """ Return lines of the tank alerts of a machine. """
+    return [html.P(f'{format_tank(tank)} {ratio:.0%}' + ('' if empty_at is None else f', empty at {empty_at:%H:%M}'))
+            for _, tank, ratio, empty_at in alerts]
+
+
 daq_dict = {
     'gradbar': [
         daq.GraduatedBar(id='gradbar-target', label='Target', value=0),
@@ -290,6 +787,18 @@ meta_tags = [
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets, meta_tags=meta_tags)
 server = app.server
+server.add_url_rule(EVENTS_PATH + '<mach_num>', 'events', stream_machine_events)
+server.add_url_rule(EVENTS_PATH + '<mach_num>/status', 'status', get_machine_status)
+server.add_url_rule(REPORTS_PATH + '<name>.csv', 'reports', stream_report)
+# Time every callback registered below, and serve the numbers to Prometheus.
+metrics = CallbackMetrics(slow_threshold=SLOW_CALLBACK_SEC)
+metrics.instrument(app)
+metrics.add_gauge('view_cache_entries', 'Entries in the shared view cache.', lambda: len(view_cache))
+metrics.add_gauge('view_cache_bytes', 'Estimated bytes of the shared view cache.', lambda: view_cache.nbytes)
+metrics.add_gauge('view_cache_hits', 'Hits of the shared view cache.', lambda: view_cache.hits)
+metrics.add_gauge('view_cache_misses', 'Misses of the shared view cache.', lambda: view_cache.misses)
+metrics.add_gauge('view_cache_waits', 'Misses that waited for the same view being built.', lambda: view_cache.waits)
+server.add_url_rule(METRICS_PATH, 'metrics', metrics.response)
 app.config.suppress_callback_exceptions = True
 
 app.title = "Coffee Machine Espresso"
@@ -299,7 +808,10 @@ app.layout = html.Div([
     # Navigation bar
     html.Div([
         build_filter(),
-        html.Div([html.Button('Start', id='start-btn')], className='navbar-2')
+        html.Div([
+            html.Button('Start', id='start-btn'),
+            html.Div(get_data_freshness(), id='data-freshness')
+        ], className='navbar-2')
     ], className='navbar'),
 
     # Content
@@ -311,7 +823,9 @@ app.layout = html.Div([
         # Left column, mainly for plots and tables.
         html.Div([
             build_card('Flavor Sales Per Hour', html.Div(dcc_graphs['time_flavor'])),
-            build_card('Sales Performance', html.Div(dcc_graphs['sales_perf']))
+            build_card('Sales Performance', html.Div(dcc_graphs['sales_perf'])),
+            build_card('Sales History', html.Div(dcc.Graph(id='fig-sales-history'))),
+            build_card('Tank History', html.Div(dcc.Graph(id='fig-tank-history')))
         ], className='left-col'),
         # Right column, mainly for states, comment, small figure, etc.
         html.Div([
@@ -321,10 +835,26 @@ app.layout = html.Div([
                     html.Div(daq_dict['led'], className='led')
                 ])
             ),
-            build_card('Tanks', html.Div(daq_dict['tank'], className='tank')),
+            build_card('Tanks', html.Div([
+                html.Div(daq_dict['tank'], className='tank'),
+                html.Div(id='tank-alerts', className='tank-alerts')
+            ])),
             build_card('Gauges', html.Div(daq_dict['gauge'], className='gauge'))
         ], className='right-col'),
     ], id='content'),
+
+    # Fleet overview of the shops in shop filter, or all shops.
+    html.Div([
+        html.H3("Fleet Overview"),
+        html.Div([
+            build_card('Fleet Sales Per Hour', html.Div(dcc.Graph(id='fig-fleet-sales'))),
+        ], className='left-col'),
+        html.Div([
+            build_card('Flavor Mix', html.Div(dcc.Graph(id='fig-fleet-mix'))),
+            build_card('Summary', html.Div(id='fleet-summary')),
+            build_card('Tank Alerts', html.Div(id='fleet-tank-alerts', className='fleet-tank-alerts'))
+        ], className='right-col'),
+    ], id='overview'),
 ])
 
 
@@ -388,99 +918,139 @@ def update_machine_value(prev_btn, next_btn, mach_opt, mach_val):
         return [mach_opt[index]['label']] * 2
 
 
-# Create callbacks for update each machine data.
-def create_refresh_data_callback(df_key_):
-    def refresh_mach_data(clock_val, mach_val):
-        now = time().fromisoformat(clock_val)
-        on_the_hour = (now.minute + now.second) == 0
-        if mach_val or on_the_hour:
-            data = read_machine_df(df_key_, mach_val,
-                                   datetime.combine(today, business_hour['open']),
-                                   datetime.combine(today, business_hour['close']))
-            data = data.to_json()
-            return [data]
-        raise PreventUpdate
-
-    return refresh_mach_data
-
-
-# At interval time.
-for df_key in list(coffee_machine_data):
-    update_mach_data_func = create_refresh_data_callback(df_key)
-    app.callback(
-        output=[Output(f'mach-{df_key}-data', 'data')],
-        inputs=[Input('clock', 'value'), Input('mach-flt', 'value')],
-    )(update_mach_data_func)
-
-
-# Create callbacks for update machine states.
-def create_state_callback(table_head):
-    def callback(n, data, clock_val):
-        if data:
-            df = pd.read_json(data)
-            now = datetime.combine(today, time().fromisoformat(clock_val))
-            daq_val = list(df.loc[df['datetime'] == now, table_head])
-            daq_val = daq_val if daq_val else [0]
-            return daq_val
-        raise PreventUpdate
-
-    return callback
-
-
-# At interval time.
-for html_id, col_name in convert_of_state_daq[:]:
-    update_machine_state_func = create_state_callback(col_name)
-    app.callback(
-        output=[Output(html_id, 'value')],
-        inputs=[Input('interval-component', 'n_intervals'), Input('mach-state-data', 'data')],
-        state=[State('clock', 'value')]
-    )(update_machine_state_func)
-
-
-# When on the hour or change mach filter value.
+# The clock runs in the browser at the replay speed, see assets/clientside.js.
+# Only a new hour is passed on to the server, to refresh the fleet overview.
+app.clientside_callback(
+    ClientsideFunction(namespace='clock', function_name='update_pseudo_time'),
+    Output('clock', 'value'),
+    Input('interval-component', 'n_intervals'),
+    State('clock', 'value'),
+    State('replay-speed', 'value'),
+    State('clock-config', 'data'),
+)
+app.clientside_callback(
+    ClientsideFunction(namespace='clock', function_name='update_hour'),
+    Output('clock-hour', 'data'),
+    Input('clock', 'value'),
+    State('clock-hour', 'data'),
+)
+
+
+# When change mach filter value or date, or new orders are pushed, send the
+# machine's day, which the browser plays by clock.
 @app.callback(
+    Output('replay-frames', 'data'),
+    Input('mach-flt', 'value'),
+    Input('mach-order-live', 'data'),
+    Input('date-range', 'end_date'),
+)
+def refresh_replay_frames(mach_val, live, end_date):
+    if mach_val:
+        return get_replay_frames(mach_val, parse_date(end_date, today))
+    raise PreventUpdate
+
+
+# At clock time, all tanks and gauges at once.
+app.clientside_callback(
+    ClientsideFunction(namespace='state', function_name='update_machine_state'),
+    [Output(html_id, 'value') for col in STATE_COLUMNS
+     for html_id, col_name in convert_of_state_daq if col_name == col],
+    Input('clock', 'value'),
+    Input('replay-frames', 'data'),
+    Input('mach-state-live', 'data'),
+)
+
+
+# On the hour or new frames, the sales of the hours before clock. Figures of
+# the same machine and day get the new hours appended.
+app.clientside_callback(
+    ClientsideFunction(namespace='replay', function_name='update_sales'),
     Output('fig-time-flavor', 'figure'), Output('fig-sales-perf', 'figure'),
-    [Output('led-espresso', 'value'), Output('led-latte', 'value'),
-     Output('led-cappuccino', 'value'), Output('led-today', 'value')],
-    Input('mach-order-data', 'data'),
-    State('clock', 'value'),
+    Output('fig-time-flavor', 'extendData'), Output('fig-sales-perf', 'extendData'),
+    Output('led-espresso', 'value'), Output('led-latte', 'value'),
+    Output('led-cappuccino', 'value'), Output('led-today', 'value'),
+    Output('fig-sales-shown', 'data'),
+    Input('clock-hour', 'data'),
+    Input('replay-frames', 'data'),
+    State('fig-sales-shown', 'data'),
+    State('fig-time-flavor', 'figure'),
+    State('fig-sales-perf', 'figure'),
 )
-def update_machine_sales_info(data, clock_val):
-    if data:
-        now = time().fromisoformat(clock_val)
-        period = (business_hour['open'].hour, now.hour)
-        sales = get_sales_df(pd.read_json(data), period)
-        if sales['amount'].any():
-            # Prepare figures
-            fig_time_flavor = get_time_flavor_graph(sales)
-            fig_sales_perf = get_sales_perf_graph(sales)
-            # Prepare counter values
-            fla_amount = sales.loc[:, ['flavor', 'amount']].groupby(['flavor']).sum()
-            fla_counter = [fla_amount.loc[choice.value][0] for choice in menu.Choices]
-            fla_counter += [sum(fla_counter)]
-            return fig_time_flavor, fig_sales_perf, *fla_counter
+
+
+# When on the hour, change shop filter value or date.
+@app.callback(
+    Output('fig-fleet-sales', 'figure'), Output('fig-fleet-mix', 'figure'),
+    Output('fleet-summary', 'children'), Output('fleet-tank-alerts', 'children'),
+    Input('clock-hour', 'data'),
+    Input('shop-flt', 'value'),
+    Input('date-range', 'end_date'),
+)
+def update_fleet_overview(hour, shop_list, end_date):
+    if hour:
+        view = get_fleet_view(shop_list, parse_date(end_date, today), int(hour))
+        return (*view['figures'], build_fleet_summary(view['summary']), view['alerts'])
     raise PreventUpdate
 
 
-# At interval time.
+# When on the hour, change mach filter value or date, and when new rows are pushed.
 @app.callback(
-    Output('clock', 'value'),
-    # Output('interval-component', 'disabled'),
-    Input('interval-component', 'n_intervals'),
+    Output('tank-alerts', 'children'),
+    Input('clock-hour', 'data'),
+    Input('mach-flt', 'value'),
+    Input('mach-order-live', 'data'),
+    Input('mach-state-live', 'data'),
+    Input('date-range', 'end_date'),
+)
+def update_tank_alerts(hour, mach_val, order_live, state_live, end_date):
+    if hour and mach_val:
+        day = parse_date(end_date, today)
+        return build_tank_alerts(get_alerts(get_alert_checkpoint(day, int(hour)),
+                                            datetime.combine(day, business_hour['close']), TANK_CAPACITY, [mach_val]))
+    raise PreventUpdate
+
+
+# When change mach filter value or date range.
+@app.callback(
+    Output('fig-sales-history', 'figure'), Output('fig-tank-history', 'figure'),
+    Input('mach-flt', 'value'),
+    Input('date-range', 'start_date'),
+    Input('date-range', 'end_date'),
+)
+def update_machine_history(mach_val, start_date, end_date):
+    start_day, end_day = parse_date(start_date), parse_date(end_date)
+    if mach_val and start_day and end_day and start_day <= end_day:
+        return get_history_view(mach_val, start_day, end_day)
+    raise PreventUpdate
+
+
+# When the data status changes, e.g. days are ingested after the app started.
+@app.callback(
+    Output('date-range', 'max_date_allowed'),
+    Input('data-freshness', 'children'),
+)
+def update_date_range(freshness):
+    latest = machine_stores['order'].latest
+    return max(DATE_RANGE[1], today if latest is None else latest.date()).isoformat()
+
+
+# Subscribe to events of the machine, and apply what was pushed.
+app.clientside_callback(
+    ClientsideFunction(namespace='live', function_name='subscribe'),
+    Output('live-machine', 'data'),
+    Input('mach-flt', 'value'),
+    State('live-path', 'data'),
+)
+app.clientside_callback(
+    ClientsideFunction(namespace='live', function_name='apply_events'),
+    Output('mach-order-live', 'data'),
+    Output('mach-state-live', 'data'),
+    Output('data-freshness', 'children'),
+    Input('live-interval', 'n_intervals'),
+    State('live-machine', 'data'),
+    State('replay-frames', 'data'),
+    State('mach-state-live', 'data'),
 )
-def update_pseudo_time(n):
-    """ Return a new time that increase by interval.
-    (Apply in demonstration only) """
-    # Normal version
-    # h, m = (n // 60), (n % 60)
-    # disabled = True if h > 21 else False
-    # return time(9+h, 0+m).strftime('%H:%M:%S'), disabled
-
-    # Debug/Demo version, boost time flow (x10)
-    h = 13 if n > 72 else (n // 6)
-    m = 0 if n > 72 else ((n * 10) % 60)
-    # disabled = True if h > 12 else False
-    return time(9 + h, 0 + m).strftime('%H:%M:%S')  # , disabled
 
 
 if __name__ == '__main__':
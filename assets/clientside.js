@@ -0,0 +1,198 @@
+// Client-side callbacks of app.py, which run every tick without a request to server.
+(function () {
+    function pad(value) {
+        return (value < 10 ? '0' : '') + value;
+    }
+
+    // Events pushed by server since last applied, see app.stream_machine_events.
+    var live = {source: null, order: null, state: [], status: null};
+
+    // Fetch the machine status now and then, in place of a refused event
+    // stream, and keep it like a pushed event when it changed.
+    function poll(mach) {
+        var now = Date.now();
+        if (live.pending || now - live.polled < live.config.poll_interval * 1000) {
+            return;
+        }
+        var current = live;
+        current.polled = now;
+        current.pending = true;
+        window.fetch(current.config.path + encodeURIComponent(mach) + '/status').then(function (response) {
+            return response.json();
+        }).then(function (data) {
+            if (current.version !== null && data.order.version !== current.version) {
+                current.order = data.order;
+            }
+            current.version = data.order.version;
+            if (data.freshness !== current.freshness) {
+                current.freshness = current.status = data.freshness;
+            }
+        }).catch(function () {}).then(function () { current.pending = false; });
+    }
+
+    // Return seconds of the day of a clock value 'HH:MM:SS'.
+    function seconds(clock) {
+        var parts = clock.split(':');
+        return (+parts[0]) * 3600 + (+parts[1]) * 60 + (+parts[2]);
+    }
+
+    // Return the index of the first of sorted seconds after now.
+    function bisect(seconds, now) {
+        var lo = 0, hi = seconds.length;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (seconds[mid] <= now) { lo = mid + 1; } else { hi = mid; }
+        }
+        return lo;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        clock: {
+            // Return clock moved by interval x speed, from open until close.
+            // (Apply in demonstration only)
+            update_pseudo_time: function (n, clock, speed, config) {
+                var now = Math.max(seconds(clock || '00:00:00'), config.open);
+                now = Math.min(now + (n ? config.interval * speed : 0), config.close);
+                var value = pad(Math.floor(now / 3600)) + ':' + pad(Math.floor(now / 60) % 60) + ':' + pad(now % 60);
+                return value === clock ? window.dash_clientside.no_update : value;
+            },
+
+            // Return the hour of clock, only when it changes.
+            update_hour: function (clock, hour) {
+                var now = clock.slice(0, 2);
+                return now === hour ? window.dash_clientside.no_update : now;
+            }
+        },
+        state: {
+            // Return the values of all tanks and gauges at clock, which is the
+            // latest row not after clock, see app.get_state_series.
+            update_machine_state: function (clock, frames, rows) {
+                if (!frames) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var data = frames.states;
+                var now = seconds(clock);
+                // Pushed rows come after the series, and are used when they are not after clock.
+                var i = rows && rows.mach_num === data.mach_num ? bisect(rows.seconds, now) : 0;
+                if (i > 0) {
+                    return rows.values.map(function (values) { return values[i - 1]; });
+                }
+                i = bisect(data.seconds, now);
+                return data.values.map(function (values) { return i > 0 ? values[i - 1] : 0; });
+            }
+        },
+        replay: {
+            // Return the figures, their extendData, LED values and the shown
+            // counts of the hours before clock hour, from frames of
+            // app.get_replay_frames. Figures showing the earlier hours of the
+            // same machine and day only get the new hours appended.
+            update_sales: function (hour, frames, shown, fig_flavor, fig_sales) {
+                var no_update = window.dash_clientside.no_update;
+                if (!frames || !hour) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var upto = Math.max(0, Math.min(+hour - frames.hours[0], frames.hours.length));
+                var counts = frames.counts.slice(0, upto);
+                var flavors = frames.counts.length ? frames.counts[0].map(function (_, f) { return f; }) : [];
+                var view = {mach_num: frames.mach_num, day: frames.day, counts: counts};
+                var counter = flavors.map(function (f) {
+                    return counts.reduce(function (total, row) { return total + row[f]; }, 0);
+                });
+                counter.push(counter.reduce(function (a, b) { return a + b; }, 0));
+
+                var start = shown ? shown.counts.length : 0;
+                var same = shown && shown.mach_num === view.mach_num && shown.day === view.day && start <= upto &&
+                    JSON.stringify(shown.counts) === JSON.stringify(counts.slice(0, start));
+                var column = function (f, lo) { return counts.slice(lo).map(function (row) { return row[f]; }); };
+                if (same) {
+                    if (start === upto) {
+                        throw window.dash_clientside.PreventUpdate;
+                    }
+                    var hours = frames.hours.slice(start, upto);
+                    return [no_update, no_update,
+                            [{x: flavors.map(function () { return hours; }),
+                              y: flavors.map(function (f) { return column(f, start); })}, flavors],
+                            [{x: [hours], y: [frames.sales.slice(start, upto)]}, [0]]]
+                        .concat(counter, [view]);
+                }
+                // Traces are bars of flavors in menu order, and a line of sales.
+                var fill = function (figure, xs, ys) {
+                    return Object.assign({}, figure, {data: xs.map(function (x, i) {
+                        return Object.assign({}, figure.data[i], {x: x, y: ys[i]});
+                    })});
+                };
+                var shown_hours = frames.hours.slice(0, upto);
+                return [fill(fig_flavor, flavors.map(function () { return shown_hours; }),
+                             flavors.map(function (f) { return column(f, 0); })),
+                        fill(fig_sales, [shown_hours], [frames.sales.slice(0, upto)]),
+                        no_update, no_update].concat(counter, [view]);
+            }
+        },
+        live: {
+            // Listen to events of the machine, instead of the previous one.
+            subscribe: function (mach, config) {
+                if (live.source) {
+                    live.source.close();
+                }
+                live = {source: null, order: null, state: [], status: null, config: config,
+                        polling: !window.EventSource, polled: 0, pending: false, version: null, freshness: null};
+                if (mach && window.EventSource) {
+                    var source = new window.EventSource(config.path + encodeURIComponent(mach));
+                    source.addEventListener('order', function (e) { live.order = JSON.parse(e.data); });
+                    source.addEventListener('state', function (e) { live.state.push(JSON.parse(e.data)); });
+                    source.addEventListener('status', function (e) { live.status = JSON.parse(e.data).freshness; });
+                    // A refused stream, e.g. 503 of a worker with too many, is not retried: poll instead.
+                    source.onerror = function () {
+                        if (source.readyState === window.EventSource.CLOSED && live.source === source) {
+                            live.source = null;
+                            live.polling = true;
+                        }
+                    };
+                    live.source = source;
+                }
+                return mach;
+            },
+
+            // Return the pushed order version, state rows and data status,
+            // or raise PreventUpdate when nothing was pushed. Without an
+            // event stream, the order version and status are polled.
+            apply_events: function (n, mach, frames, rows) {
+                var no_update = window.dash_clientside.no_update;
+                if (live.polling && mach) {
+                    poll(mach);
+                }
+                if (live.order === null && !live.state.length && live.status === null) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var order = live.order === null ? no_update : live.order;
+                var status = live.status === null ? no_update : live.status;
+                var state = no_update;
+                var series = frames && frames.states;
+                if (live.state.length && series && series.mach_num === mach) {
+                    // Keep rows after the series only, which has the older rows after a refresh.
+                    var last = series.seconds.length ? series.seconds[series.seconds.length - 1] : -1;
+                    var old = rows && rows.mach_num === mach ? rows : {seconds: [], values: []};
+                    rows = {mach_num: mach, seconds: [], values: series.columns.map(function () { return []; })};
+                    var add = function (second, values, i) {
+                        if (second > last && (!rows.seconds.length || second >= rows.seconds[rows.seconds.length - 1])) {
+                            rows.seconds.push(second);
+                            rows.values.forEach(function (column, col) { column.push(values[col][i]); });
+                        }
+                    };
+                    old.seconds.forEach(function (second, i) { add(second, old.values, i); });
+                    live.state.forEach(function (event) {
+                        if (event.mach_num !== mach || event.day !== series.day) {
+                            return;
+                        }
+                        event.seconds.forEach(function (second, i) { add(second, event.values, i); });
+                    });
+                    state = rows;
+                }
+                live.order = null;
+                live.state = [];
+                live.status = null;
+                return [order, state, status];
+            }
+        }
+    });
+})();
@@ -0,0 +1,197 @@
+# encoding=utf-8
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+APP_PATH = os.path.dirname(os.path.abspath(__file__))
+BASE_FLEET = {'shops': 3, 'machines_per_shop': 3}  # About the size of the demo data.
+SCALES = [1, 10, 100]
+REPEAT = 50
+PERCENTILES = [50, 90, 99]
+
+
+def get_commit():
+    """ Return the git commit of the working tree, or None. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_PATH,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def payload_size(value):
+    """ Return the bytes of value serialized like Dash does for a response. """
+    from plotly.utils import PlotlyJSONEncoder
+    return len(json.dumps(value, cls=PlotlyJSONEncoder).encode('utf-8'))
+
+
+def measure(func, make_args, repeat, payload=True):
+    """ Call func(*make_args()) repeat times, and return latency percentiles
+    in ms, peak traced memory in bytes and the mean payload bytes, which is
+    0 for data paths that do not answer a request (payload=False). """
+    from dash.exceptions import PreventUpdate
+
+    latencies, payloads, prevented = [], [], 0
+    for _ in range(repeat):
+        args = make_args()
+        tick = time.perf_counter()
+        try:
+            result = func(*args)
+        except PreventUpdate:
+            result, prevented = None, prevented + 1
+        latencies.append((time.perf_counter() - tick) * 1000)
+        if payload and result is not None:
+            payloads.append(payload_size(result))
+
+    # Peak memory of one more call, traced apart from the timed calls.
+    tracemalloc.start()
+    try:
+        func(*make_args())
+    except PreventUpdate:
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {f'p{p}_ms': round(float(np.percentile(latencies, p)), 3) for p in PERCENTILES}
+    result.update({
+        'mean_ms': round(float(np.mean(latencies)), 3),
+        'max_ms': round(float(np.max(latencies)), 3),
+        'calls': repeat,
+        'prevented': prevented,
+        'peak_memory_bytes': peak,
+        'payload_bytes': int(np.mean(payloads)) if payloads else 0
+    })
+    return result
+
+
+def run_cases(repeat):
+    """ Import the app on the data in the working directory, and measure
+    its callbacks and data paths. Return a dict of results by case name. """
+    import app
+
+    app.ingestor.stop()
+    machines = app.machine_stores['order'].machines()
+    open_hour, close_hour = app.business_hour['open'].hour, app.business_hour['close'].hour
+
+    def hour():
+        return f'{random.randrange(open_hour, close_hour):02d}'
+
+    def sales_df():
+        return app.sales_rollup.get_sales_df(random.choice(machines), app.today, (open_hour, close_hour))
+
+    def raw_orders():
+        return app.read_machine_df('order', random.choice(machines),
+                                   datetime.combine(app.today, app.business_hour['open']),
+                                   datetime.combine(app.today, app.business_hour['close'])).copy()
+
+    cases = {
+        'refresh_replay_frames': (app.refresh_replay_frames, lambda: (random.choice(machines), None, None)),
+        'refresh_replay_frames[uncached]': (app.refresh_replay_frames,
+                                            lambda: (app.view_cache.clear(), random.choice(machines), None, None)[1:]),
+        'update_fleet_overview': (app.update_fleet_overview, lambda: (hour(), None, None)),
+        'update_tank_alerts': (app.update_tank_alerts, lambda: (hour(), random.choice(machines), None, None, None)),
+        'get_sales_df': (app.get_sales_df, lambda: (raw_orders(), (open_hour, close_hour))),
+        'get_time_flavor_graph': (app.get_time_flavor_graph, lambda: (sales_df(),)),
+        'get_sales_perf_graph': (app.get_sales_perf_graph, lambda: (sales_df(),)),
+        'load_coffee_machine_data': (app.load_coffee_machine_data, lambda: ()),
+        'init_coffee_machine_data': (app.init_coffee_machine_data, lambda: ()),
+    }
+    slow = {'load_coffee_machine_data', 'init_coffee_machine_data'}
+    data_paths = slow | {'get_sales_df'}
+    results = dict()
+    for name, (func, make_args) in cases.items():
+        results[name] = measure(func, make_args, max(repeat // 10, 3) if name in slow else repeat,
+                                payload=name not in data_paths)
+        print(f"  {name}: p50 {results[name]['p50_ms']} ms, p99 {results[name]['p99_ms']} ms", file=sys.stderr)
+    results['_rows'] = {key: len(store) for key, store in app.machine_stores.items()}
+    return results
+
+
+def run_scale(scale, days, repeat, workdir, seed):
+    """ Generate a dataset of the scale, and measure it in a new process,
+    so the app imports its own data. """
+    import generator
+
+    path = os.path.join(workdir, f'scale-{scale}')
+    os.makedirs(path, exist_ok=True)
+    database = os.path.join(path, 'coffeemachine.db')
+    snapshot_dir = os.path.join(path, 'snapshot')
+    if not os.path.exists(database):
+        generator.generate(BASE_FLEET['shops'] * scale, BASE_FLEET['machines_per_shop'], days,
+                           datetime(2021, 1, 1).date(), backend='sqlite', database=database,
+                           snapshot_dir=snapshot_dir, seed=seed)
+    env = dict(os.environ, SNAPSHOT_DIR=snapshot_dir, DATABASE_BACKEND='sqlite',
+               PYTHONPATH=os.pathsep.join([APP_PATH, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(APP_PATH, 'benchmark.py'), '--worker', '--repeat', str(repeat)],
+        cwd=path, env=env, text=True)
+    return json.loads(output.strip().splitlines()[-1])  # The app may print before.
+
+
+def compare(base_path, new_path):
+    """ Print p50 and p99 of two result files side by side. """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'scale':>6} {'case':<28} {'p50 base':>10} {'p50 new':>10} {'ratio':>7}")
+    for scale, cases in new['results'].items():
+        for name, result in cases.items():
+            old = base['results'].get(scale, {}).get(name)
+            if name.startswith('_') or old is None:
+                continue
+            ratio = result['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('nan')
+            print(f"{scale:>6} {name:<28} {old['p50_ms']:>10} {result['p50_ms']:>10} {ratio:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dashboard callbacks and data paths.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help=f"fleet size as multiples of {BASE_FLEET}")
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--workdir', default=None, help='keep generated datasets here for reuse')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.worker:
+        random.seed(args.seed)
+        print(json.dumps(run_cases(args.repeat)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='coffee-bench-')
+    report = {
+        'commit': get_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'days': args.days,
+        'repeat': args.repeat,
+        'results': dict()
+    }
+    for scale in args.scales:
+        print(f'Scale x{scale}:', file=sys.stderr)
+        report['results'][str(scale)] = run_scale(scale, args.days, args.repeat, workdir, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results are written to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# encoding=utf-8
+
+from contextlib import contextmanager
+import itertools
+import json
+import queue
+import threading
+
+QUEUE_SIZE = 64  # Messages a slow subscriber may fall behind, older ones are dropped.
+HEARTBEAT = 15  # sec, a comment line keeps idle connections open.
+
+
+def format_event(event, data, event_id=None):
+    """ Return a message of the server-sent events format. """
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in json.dumps(data, default=str).splitlines())
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """ A queue of messages of the topics a client listens to. """
+
+    def __init__(self, topics, maxsize=QUEUE_SIZE):
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        """ Add a message, drop the oldest one if the client falls behind. """
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=HEARTBEAT):
+        """ Return the next message, or None after timeout. """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    """ An in-process publish/subscribe hub for server-sent events.
+
+    A message is formatted once when published, and the same string is put
+    into the queue of every subscriber of its topic, so fanning out to many
+    dashboards costs a queue put each. Nothing is sent without a publish.
+    """
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.published = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def topics(self):
+        """ Return the set of topics anyone subscribes to. """
+        with self._lock:
+            return set().union(*(s.topics for s in self.subscriptions))
+
+    def publish(self, topic, event, data):
+        """ Send data as event to subscribers of topic, and return how many got it. """
+        with self._lock:
+            targets = [s for s in self.subscriptions if topic in s.topics]
+            if not targets:
+                return 0
+            message = format_event(event, data, next(self._ids))
+            self.published += 1
+        for subscription in targets:
+            subscription.put(message)
+        return len(targets)
+
+    def open(self, topics, limit=None):
+        """ Return a new Subscription of topics, or None when limit
+        subscriptions are open already. It is removed by close(). """
+        with self._lock:
+            if limit is not None and len(self.subscriptions) >= limit:
+                return None
+            subscription = Subscription(topics)
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def close(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    @contextmanager
+    def subscribe(self, topics):
+        """ Yield a Subscription of topics, which is removed on exit. """
+        subscription = self.open(topics)
+        try:
+            yield subscription
+        finally:
+            self.close(subscription)
+
+    def stream(self, subscription, initial=(), heartbeat=HEARTBEAT):
+        """ Yield server-sent events of an open subscription until the client
+        disconnects, after the initial messages, then close it. """
+        try:
+            yield f'retry: {heartbeat * 1000}\n\n'
+            yield from initial
+            while True:
+                message = subscription.get(heartbeat)
+                yield ': keep-alive\n\n' if message is None else message
+        finally:
+            self.close(subscription)
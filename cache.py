@@ -0,0 +1,155 @@
+# encoding=utf-8
+
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+
+class _Flight:
+    """ A call of get_or_put in progress, which other callers wait for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def estimate_size(value, seen=None):
+    """ Return the estimated bytes of value and the objects it holds:
+    arrays and frames by their buffers, containers and plain objects by
+    their items. Objects held more than once are counted once. """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if hasattr(value, 'memory_usage'):  # pandas frames and series
+        return int(value.memory_usage(deep=True, index=True).sum())
+    if hasattr(value, 'nbytes'):  # numpy arrays
+        return int(value.nbytes)
+    if hasattr(value, 'to_plotly_json'):  # plotly figures and dash components
+        value = value.to_plotly_json()
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(i, seen) for i in value)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value), seen)
+    return size
+
+
+class LRUCache:
+    """ A thread-safe mapping with LRU eviction and a time-to-live.
+
+    When `maxsize` entries are held, putting a new key evicts the least
+    recently used one. With `maxbytes`, entries are also evicted while their
+    sizes by `sizeof(value)` add up to more than it, but the newest entry is
+    kept. Entries older than `ttl` seconds are treated as missing,
+    `ttl=None` keeps them until evicted. `get_or_put` is single-flight:
+    concurrent misses of a key compute its value once.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, sizeof=estimate_size):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0  # Sizes of the entries, when maxbytes is set.
+        self._data = OrderedDict()  # {key: (stamp, value, size)}
+        self._lock = threading.Lock()
+        self._flights = dict()  # {key: _Flight}
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0  # Misses served by another caller's computation.
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, touch=False) is not None
+
+    def _expired(self, stamp):
+        return self.ttl is not None and (time.monotonic() - stamp) > self.ttl
+
+    def get(self, key, default=None, touch=True):
+        """ Return the value of key, or default if it is missing or expired. """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0]):
+                if item is not None:
+                    self._remove(key)
+                if touch:
+                    self.misses += 1
+                return default
+            if touch:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return item[1]
+
+    def _remove(self, key):
+        self.nbytes -= self._data.pop(key)[2]
+
+    def put(self, key, value):
+        """ Set value of key, and evict the least recently used entries. """
+        size = self.sizeof(value) if self.maxbytes is not None else 0  # Outside the lock, it walks value.
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic(), value, size)
+            self.nbytes += size
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes is not None and self.nbytes > self.maxbytes and len(self._data) > 1):
+                self._remove(next(iter(self._data)))
+        return value
+
+    def get_or_put(self, key, func):
+        """ Return the value of key, call func() to create it on a miss.
+        While func() runs, other callers of the same key wait for its value
+        instead of calling func() again. """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.waits += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            value = self.get(key, touch=False)  # Put by a flight that just ended.
+            flight.value = value if value is not None else self.put(key, func())
+            return flight.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def invalidate(self, predicate):
+        """ Remove entries which predicate(key) is true, and return how many. """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._remove(key)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
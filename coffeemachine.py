@@ -35,11 +35,11 @@ class CoffeeMachine:
         REMAINING = auto()
         EXIT = auto()
     
-    supplies = dict()
     menu = Menu()
     clerk = 'Jack'
 
     def __init__(self, water=0, milk=0, beans=0, cups=0, money=0):
+        self.supplies = dict()  # Per instance, machines do not share supplies.
         self.supplies['water'] = water
         self.supplies['milk'] = milk
         self.supplies['beans'] = beans
@@ -1,5 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+import io
 import os
+import queue
+import re
 import sqlite3
+import threading
+import uuid
 import psycopg2
 import pandas as pd
 
@@ -7,19 +16,294 @@ import pandas as pd
 APP_PATH = os.path.dirname(os.path.abspath(__file__))
 DATABASE_DIR = os.path.join(APP_PATH, 'data')
 DATABASE_NAME = 'coffeemachine.db'
-DATABASE_TABLES = ['machine_order', 'machine_state']
+DATABASE_TABLES = ['machine_order', 'machine_state', 'machine_refill']
+DATABASE_BACKEND = os.environ.get('DATABASE_BACKEND', 'postgres')  # or 'sqlite'
+# Columns of the tables, see create_tables().
+TABLE_COLUMNS = {
+    'machine_order': [('date', 'TEXT'), ('time', 'TEXT'), ('shop', 'TEXT'), ('mach_num', 'TEXT'),
+                      ('flavor', 'TEXT')],
+    'machine_state': [('date', 'TEXT'), ('time', 'TEXT'), ('shop', 'TEXT'), ('mach_num', 'TEXT'),
+                      ('tank_water', 'INTEGER'), ('tank_milk', 'INTEGER'), ('tank_beans', 'INTEGER'),
+                      ('barometer', 'REAL'), ('thermometer', 'REAL')],
+    'machine_refill': [('date', 'TEXT'), ('time', 'TEXT'), ('shop', 'TEXT'), ('mach_num', 'TEXT'),
+                       ('water', 'INTEGER'), ('milk', 'INTEGER'), ('beans', 'INTEGER'), ('cups', 'INTEGER')]
+}
+# Index of the columns that queries filter on, see create_indexes().
+DATABASE_INDEXES = {
+    'mach_num': ['mach_num', 'date', 'time'],
+    'shop': ['shop', 'date', 'time'],
+    'datetime': ['date', 'time']  # Polls of rows since a watermark.
+}
+# Derived columns, which can be used in 'group_by' of a query.
+DERIVED_COLUMNS = {'hour': 'SUBSTR(time, 1, 2)'}
+AGGREGATE_FUNCTIONS = ['count', 'sum', 'avg', 'min', 'max']
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 4))
+POOL_TIMEOUT = 30  # sec, wait for a free connection
+CHUNK_SIZE = 10000  # rows
+LOAD_SHARDS = int(os.environ.get('DATABASE_LOAD_SHARDS', 1))  # Date-range shards of each table in read_tables.
 
 
-def read_from_sqlite(table_name, columns=None, index_col=None):
-    conn, result = None, None
-    columns = '*' if columns is None else columns
+class ConnectionPool:
+    """ A bounded pool of database connections, for reuse in one worker process.
+
+    At most `maxsize` connections are open, `connection()` blocks until one is
+    free. An idle connection is health checked before reuse, and replaced if
+    it is broken. After fork (e.g. gunicorn workers), the pool starts over
+    with new connections instead of sharing the parent's sockets.
+    """
+
+    def __init__(self, connect, maxsize=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self._connect = connect
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.maxsize)
+
+    @staticmethod
+    def is_healthy(conn):
+        try:
+            if getattr(conn, 'closed', 0):
+                return False
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _put(self, conn):
+        """ End the read transaction of conn, if any, and return it to the
+        pool, or close it if that fails. """
+        try:
+            conn.rollback()
+            self._idle.put(conn)
+        except Exception:
+            self._close(conn)
+
+    def _get(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self.is_healthy(conn):
+                return conn
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """ Yield a pooled connection, which returns to the pool afterward. """
+        if self._pid != os.getpid():
+            self._reset()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free database connection in {self.timeout} sec.")
+        conn = None
+        try:
+            conn = self._get()
+            yield conn
+        except GeneratorExit:
+            # The caller stopped early, e.g. closed a generator of chunks, the connection is still good.
+            self._put(conn)
+            raise
+        except BaseException:
+            if conn is not None:
+                self._close(conn)
+            raise
+        else:
+            self._put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """ Close all idle connections. """
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(backend):
+    """ Return the connection pool of 'sqlite' or 'postgres'. """
+    with _pools_lock:
+        if backend not in _pools:
+            if backend == 'sqlite':
+                connect = partial(sqlite3.connect, DATABASE_NAME, check_same_thread=False)
+            elif backend == 'postgres':
+                connect = partial(psycopg2.connect, os.environ['DATABASE_URL'], sslmode='require')
+            else:
+                raise ValueError(f"Unknown database backend: {backend!r}")
+            _pools[backend] = ConnectionPool(connect)
+        return _pools[backend]
+
+
+def check_identifier(name):
+    """ Return name if it is a plain SQL identifier, to keep names out of injection. """
+    if name != '*' and not IDENTIFIER.match(name):
+        raise ValueError(f"Invalid SQL identifier: {name!r}")
+    return name
+
+
+def check_columns(columns):
+    """ Return the select list of columns, a list or a comma separated string
+    of identifiers, '*' or 'name AS alias', with each name checked. """
+    items = columns.split(',') if isinstance(columns, str) else list(columns)
+    exprs = []
+    for item in items:
+        names = re.split(r'\s+AS\s+', item.strip(), flags=re.IGNORECASE)
+        if len(names) > 2 or (len(names) == 2 and '*' in names):
+            raise ValueError(f"Invalid SQL column: {item!r}")
+        exprs.append(' AS '.join(check_identifier(name) for name in names))
+    return ', '.join(exprs)
+
+
+def split_datetime(dt):
+    """ Return (date, time) strings, as stored in the tables. """
+    return dt.strftime('%Y-%m-%d'), dt.strftime('%H:%M:%S')
+
+
+def build_query(table_name, columns=None, placeholder='%s', mach_num=None, shop=None,
+                start_dt=None, end_dt=None, since=None, after_rowid=None, group_by=None, aggregates=None):
+    """ Return (query, params) of a SELECT, which pushes given filters down to SQL.
+
+    * columns: see check_columns, all columns by default.
+    * mach_num, shop: a value or a non-empty list of values.
+    * start_dt <= (date, time) < end_dt, or (date, time) >= since.
+    * after_rowid: rowid > after_rowid, sqlite only.
+    * group_by: a list of columns, or derived columns such as 'hour'.
+    * aggregates: a dict of {output_name: (function, column)},
+      e.g. {'amount': ('count', '*')}.
+    All values are sent as bound parameters.
+    """
+    check_identifier(table_name)
+    conditions, params = [], []
+    for col, value in [('mach_num', mach_num), ('shop', shop)]:
+        if value is None:
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        if not values:
+            raise ValueError(f"Empty list of {col} values")
+        conditions.append(f"{col} IN ({', '.join([placeholder] * len(values))})")
+        params.extend(values)
+    for op, dt in [('>=', start_dt), ('<', end_dt), ('>=', since)]:
+        if dt is None:
+            continue
+        conditions.append(f'(date, time) {op} ({placeholder}, {placeholder})')
+        params.extend(split_datetime(dt))
+    if after_rowid is not None:
+        conditions.append(f'rowid > {placeholder}')
+        params.append(int(after_rowid))
+
+    if group_by or aggregates:
+        group_by = [] if group_by is None else group_by
+        aggregates = dict() if aggregates is None else aggregates
+        select = [f'{DERIVED_COLUMNS[col]} AS {col}' if col in DERIVED_COLUMNS else check_identifier(col)
+                  for col in group_by]
+        for name, (func, col) in aggregates.items():
+            if func.lower() not in AGGREGATE_FUNCTIONS:
+                raise ValueError(f"Unsupported aggregate function: {func!r}")
+            select.append(f'{func.upper()}({check_identifier(col)}) AS {check_identifier(name)}')
+        columns = ', '.join(select)
+    else:
+        columns = '*' if columns is None else check_columns(columns)
+
+    query = f'SELECT {columns} FROM {table_name}'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if group_by:
+        exprs = [DERIVED_COLUMNS.get(col, col) for col in group_by]
+        query += f" GROUP BY {', '.join(exprs)} ORDER BY {', '.join(exprs)}"
+    return query, tuple(params)
+
+
+def table_exists(conn, table):
+    """ Return True if a table exists, on an open sqlite or postgres connection. """
+    cur = conn.cursor()
+    if isinstance(conn, sqlite3.Connection):
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    else:
+        cur.execute("SELECT to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    cur.close()
+    return row is not None and row[0] is not None
+
+
+def create_indexes(conn, tables=None):
+    """ Create the composite indexes that filtered queries use, on an open
+    connection. Tables that do not exist, e.g. machine_refill of a database
+    made before it, are skipped. """
+    tables = DATABASE_TABLES if tables is None else tables
+    tables = [table for table in tables if table_exists(conn, check_identifier(table))]
+    cur = conn.cursor()
+    for table in tables:
+        for name, cols in DATABASE_INDEXES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {check_identifier(table)}_{name}_idx "
+                        f"ON {table} ({', '.join(cols)})")
+    conn.commit()
+    cur.close()
+
+
+def create_tables(conn, tables=None):
+    """ Create the tables of TABLE_COLUMNS if they do not exist, on an open connection. """
+    tables = list(TABLE_COLUMNS) if tables is None else tables
+    cur = conn.cursor()
+    for table in tables:
+        columns = ', '.join(f'{name} {kind}' for name, kind in TABLE_COLUMNS[table])
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {check_identifier(table)} ({columns})")
+    conn.commit()
+    cur.close()
+
+
+def write_to_sqlite(conn, table_name, df, batch_size=CHUNK_SIZE):
+    """ Insert rows of df to a sqlite table in batches, in one transaction. """
+    columns = [name for name, _ in TABLE_COLUMNS[table_name]]
+    query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+    cur = conn.cursor()
+    for start in range(0, len(df), batch_size):
+        rows = df.iloc[start:start + batch_size][columns]
+        cur.executemany(query, rows.itertuples(index=False, name=None))
+    conn.commit()
+    cur.close()
+
+
+def copy_to_postgres(conn, table_name, df):
+    """ Load rows of df to a postgres table with COPY, much faster than INSERT. """
+    columns = [name for name, _ in TABLE_COLUMNS[table_name]]
+    buffer = io.StringIO()
+    df[columns].to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    cur = conn.cursor()
+    cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH CSV", buffer)
+    conn.commit()
+    cur.close()
+
+
+def read_from_sqlite(table_name, columns=None, index_col=None, **filters):
+    """ Read a table from sqlite, filters are arguments of build_query(). """
+    result = None
     try:
-        with sqlite3.connect(DATABASE_NAME) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_pool('sqlite').connection() as conn:
             cur = conn.cursor()
-            query = f'SELECT {columns} FROM {table_name}'
-            cur.execute(query)
-            index_col = cur.fetchone().keys() if index_col is None else index_col
+            query, params = build_query(table_name, columns, placeholder='?', **filters)
+            cur.execute(query, params)
+            index_col = [i[0] for i in cur.description] if index_col is None else index_col
             result = pd.DataFrame(data=cur.fetchall(), columns=index_col)
             cur.close()
     except Exception as error:
@@ -28,15 +312,123 @@ def read_from_sqlite(table_name, columns=None, index_col=None):
         return result
 
 
-def read_from_postgres(table_name, columns=None):
-    db_url = os.environ['DATABASE_URL']
+def read_from_postgres(table_name, columns=None, **filters):
+    """ Read a table from postgres, filters are arguments of build_query(). """
     result = None
-    columns = '*' if columns is None else columns
     try:
-        with psycopg2.connect(db_url, sslmode='require') as conn:
-            query = f'SELECT {columns} FROM {table_name}'
-            result = pd.read_sql_query(query, conn)
+        with get_pool('postgres').connection() as conn:
+            query, params = build_query(table_name, columns, placeholder='%s', **filters)
+            result = pd.read_sql_query(query, conn, params=params)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
     finally:
         return result
+
+
+def iter_from_sqlite(table_name, columns=None, chunksize=CHUNK_SIZE, **filters):
+    """ Yield dataframes of at most chunksize rows, so memory stays flat
+    whatever the result size. Filters are arguments of build_query().
+    Errors are raised, so a failed read is not taken for a short result. """
+    with get_pool('sqlite').connection() as conn:
+        cur = conn.cursor()
+        try:
+            query, params = build_query(table_name, columns, placeholder='?', **filters)
+            cur.execute(query, params)
+            names = [i[0] for i in cur.description]
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield pd.DataFrame(data=rows, columns=names)
+        finally:
+            cur.close()
+
+
+def iter_from_postgres(table_name, columns=None, chunksize=CHUNK_SIZE, **filters):
+    """ Yield dataframes of at most chunksize rows, read by a server-side
+    cursor. Filters are arguments of build_query(). Errors are raised, so
+    a failed read is not taken for a short result. """
+    with get_pool('postgres').connection() as conn:
+        # A named cursor keeps the result on server, and sends it in chunks.
+        cur = conn.cursor(name=f'iter_{uuid.uuid4().hex}')
+        try:
+            cur.itersize = chunksize
+            query, params = build_query(table_name, columns, placeholder='%s', **filters)
+            cur.execute(query, params)
+            names = None
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if names is None:
+                    names = [i[0] for i in cur.description]
+                if not rows:
+                    break
+                yield pd.DataFrame(data=rows, columns=names)
+        finally:
+            cur.close()
+
+
+def read_table(table_name, columns=None, backend=None, **filters):
+    """ Read a table from the configured backend, see DATABASE_BACKEND. """
+    backend = DATABASE_BACKEND if backend is None else backend
+    if backend == 'sqlite':
+        return read_from_sqlite(table_name, columns, **filters)
+    return read_from_postgres(table_name, columns, **filters)
+
+
+def iter_table(table_name, columns=None, backend=None, **filters):
+    """ Yield chunks of a table from the configured backend. """
+    backend = DATABASE_BACKEND if backend is None else backend
+    if backend == 'sqlite':
+        return iter_from_sqlite(table_name, columns, **filters)
+    return iter_from_postgres(table_name, columns, **filters)
+
+
+def run_concurrently(funcs, max_workers=POOL_SIZE):
+    """ Call each of a dict of {key: function} in a thread pool, and return
+    a dict of {key: result}. An exception of any call is raised. """
+    if len(funcs) < 2 or max_workers < 2:
+        return {key: func() for key, func in funcs.items()}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(funcs)), thread_name_prefix='read') as executor:
+        futures = {key: executor.submit(func) for key, func in funcs.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def get_shard_ranges(table_name, shards, backend=None):
+    """ Return a list of (start_dt, end_dt) which split a table into about
+    equal date ranges. The first start and the last end are None, so no row
+    is left out. """
+    bounds = read_table(table_name, backend=backend,
+                        aggregates={'first_day': ('min', 'date'), 'last_day': ('max', 'date')})
+    if shards < 2 or bounds is None or not len(bounds) or bounds['first_day'][0] is None:
+        return [(None, None)]
+    first = datetime.strptime(bounds['first_day'][0], '%Y-%m-%d')
+    days = (datetime.strptime(bounds['last_day'][0], '%Y-%m-%d') - first).days + 1
+    cuts = sorted({round(days * i / shards) for i in range(1, shards)} - {0, days})
+    edges = [None] + [first + timedelta(days=i) for i in cuts] + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def read_tables(tables, backend=None, shards=LOAD_SHARDS, transform=None, concat=None, max_workers=POOL_SIZE):
+    """ Read tables, each in date-range shards, concurrently on pooled
+    connections, and return a dict of {key: dataframe}, None for a table
+    that failed. Each shard is passed to transform(df, key) in its thread as
+    soon as it is read, so parsing overlaps reads of other shards.
+
+    :param tables: a dict of {key: table_name}, e.g. {'order': 'machine_order'}.
+    :param concat: a function joining a list of shards, default pd.concat.
+    """
+    concat = (lambda frames: pd.concat(frames, ignore_index=True)) if concat is None else concat
+
+    def read_shard(key, start_dt, end_dt):
+        df = read_table(tables[key], backend=backend, start_dt=start_dt, end_dt=end_dt)
+        return df if df is None or transform is None else transform(df, key)
+
+    ranges = run_concurrently({key: lambda table=table: get_shard_ranges(table, shards, backend)
+                               for key, table in tables.items()}, max_workers) \
+        if shards > 1 else {key: [(None, None)] for key in tables}
+    jobs = {(key, i): lambda key=key, start=start, end=end: read_shard(key, start, end)
+            for key in tables for i, (start, end) in enumerate(ranges[key])}
+    results = run_concurrently(jobs, max_workers)
+    frames = {key: [results[(key, i)] for i in range(len(ranges[key]))] for key in tables}
+    return {key: None if any(df is None for df in parts) else (parts[0] if len(parts) == 1 else concat(parts))
+            for key, parts in frames.items()}
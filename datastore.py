@@ -0,0 +1,176 @@
+# encoding=utf-8
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from schema import union_categories
+
+
+def machine_keys(df):
+    """ Return (keys, labels) of the mach_num column, keys are comparable
+    per row and labels[key] is the machine number. Categorical columns use
+    their codes, so no string array is made. """
+    mach = df['mach_num']
+    if isinstance(mach.dtype, pd.CategoricalDtype):
+        return mach.cat.codes.to_numpy(), mach.cat.categories
+    keys = mach.to_numpy()
+    return keys, None
+
+
+def is_sorted_by_machine(keys, stamps):
+    """ Return True if rows are already sorted by (mach_num, datetime). """
+    if len(keys) < 2:
+        return True
+    ahead, same = keys[1:] > keys[:-1], keys[1:] == keys[:-1]
+    return bool(np.all(ahead | (same & (stamps[1:] >= stamps[:-1]))))
+
+
+def split_by_machine(df):
+    """ Return df sorted by (mach_num, datetime), and a list of
+    (mach_num, start, stop) of each machine's rows in it.
+    A sorted df is used as it is, e.g. read-only mapped snapshot columns. """
+    keys, labels = machine_keys(df)
+    if not is_sorted_by_machine(keys, to_stamps(df['datetime'])):
+        df = df.sort_values(['mach_num', 'datetime'], kind='mergesort').reset_index(drop=True)
+        keys, labels = machine_keys(df)
+    if not len(keys):
+        return df, []
+    edges = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], edges))
+    stops = np.concatenate((edges, [len(keys)]))
+    return df, [(keys[start] if labels is None else labels[keys[start]], start, stop)
+                for start, stop in zip(starts, stops)]
+
+
+def merge_chunks(chunks, concat):
+    """ Merge the newest chunks while the last one is not much smaller than
+    the one before, like a binary counter. Keeps O(log n) chunks per machine,
+    and each row is copied O(log n) times in total. """
+    while len(chunks) > 1 and len(chunks[-2][1]) <= 2 * len(chunks[-1][1]):
+        last = chunks.pop()
+        chunks[-1] = concat(chunks[-1], last)
+
+
+def add_chunk(chunks, chunk, concat, take):
+    """ Add a chunk of a machine's sorted rows to its chunks. Rows earlier
+    than the machine's last row, e.g. inserted late with an old time, are
+    merged with the chunks they overlap and sorted into place, so chunks stay
+    sorted and in order of time.
+
+    :param concat: a function of two chunks, which returns one.
+    :param take: a function of a chunk and row positions, which returns a chunk.
+    """
+    times = chunk[1]
+    if not chunks or chunks[-1][1][-1] <= times[0]:
+        chunks.append(chunk)
+    else:
+        i = len(chunks)
+        while i > 0 and chunks[i - 1][1][-1] > times[0]:
+            i -= 1
+        merged = chunk
+        for old in reversed(chunks[i:]):
+            merged = concat(old, merged)
+        chunks[i:] = [take(merged, np.argsort(merged[1], kind='mergesort'))]
+    merge_chunks(chunks, concat)
+
+
+def to_stamps(times):
+    """ Return datetimes as int64 nanoseconds. """
+    return np.asarray(times).astype('datetime64[ns]', copy=False).view(np.int64)
+
+
+class MachineStore:
+    """ In-memory index of a machine table (order or state).
+
+    Rows are sorted by (mach_num, datetime) once, and each machine is kept as
+    a contiguous slice of the sorted frame. A machine/time-window lookup is a
+    dict hit plus a binary search on the datetime column, and returns a slice
+    of the underlying frame instead of a filtered copy.
+
+    New rows are appended by `append` as chunks of each machine, so its cost
+    is proportional to the new rows. Rows are usually later than the rows the
+    machine already has, such as rows after a watermark; late rows with an
+    older time are sorted into place, see add_chunk.
+    """
+
+    def __init__(self, df, version=0):
+        self.columns = list(df.columns)
+        self.chunks = dict()  # {mach_num: [(frame, int64 times), ...]}
+        self.versions = dict()
+        self.version = version  # Generation of the store, e.g. a reload of the snapshot.
+        self.latest = None
+        self._df = None
+        self._empty = df.iloc[0:0]
+        self._lock = threading.Lock()
+        self.append(df)
+
+    def __len__(self):
+        return sum(len(times) for chunks in list(self.chunks.values()) for _, times in chunks)
+
+    def __contains__(self, mach_num):
+        return mach_num in self.chunks
+
+    @property
+    def df(self):
+        """ All rows as one dataframe, sorted by (mach_num, datetime).
+        It is the sorted frame of the first rows, or a copy after appends. """
+        if self._df is not None:
+            return self._df
+        frames = [frame for chunks in list(self.chunks.values()) for frame, _ in chunks]
+        return pd.concat(union_categories(frames), ignore_index=True) if frames else self._empty
+
+    @staticmethod
+    def _concat(a, b):
+        return pd.concat(union_categories([a[0], b[0]]), ignore_index=True), np.concatenate([a[1], b[1]])
+
+    @staticmethod
+    def _take(chunk, rows):
+        return chunk[0].iloc[rows].reset_index(drop=True), chunk[1][rows]
+
+    def append(self, df):
+        """ Add rows to the store, and return the machines that got rows. """
+        if df is None or not len(df):
+            return []
+        if list(df.columns) != self.columns:
+            df = df[self.columns]  # Selecting columns copies, so only do it when needed.
+        df, bounds = split_by_machine(df)
+        times = to_stamps(df['datetime'])
+        with self._lock:
+            # Chunks of the first rows are slices of one sorted frame, keep it.
+            self._df = df if not self.chunks else None
+            for mach_num, start, stop in bounds:
+                chunks = self.chunks.setdefault(mach_num, [])
+                add_chunk(chunks, (df.iloc[start:stop], times[start:stop]), self._concat, self._take)
+                self.versions[mach_num] = self.versions.get(mach_num, 0) + 1
+            latest = pd.Timestamp(times.max())
+            self.latest = latest if self.latest is None else max(self.latest, latest)
+        return [mach_num for mach_num, _, _ in bounds]
+
+    def machines(self):
+        """ Return machine numbers held by the store. """
+        return list(self.chunks)
+
+    def machine_version(self, mach_num):
+        """ Return a token that changes when rows of the machine change. """
+        return f'{self.version}.{self.versions.get(mach_num, 0)}'
+
+    def empty(self):
+        """ Return an empty dataframe with the store's columns. """
+        return self._empty
+
+    def read(self, mach_num, start_dt=None, end_dt=None):
+        """ Return rows of a machine where start_dt <= datetime < end_dt. """
+        start = None if start_dt is None else np.datetime64(start_dt, 'ns').view(np.int64)
+        end = None if end_dt is None else np.datetime64(end_dt, 'ns').view(np.int64)
+        pieces = []
+        for frame, times in list(self.chunks.get(mach_num, [])):
+            lo = 0 if start is None else np.searchsorted(times, start, side='left')
+            hi = len(times) if end is None else np.searchsorted(times, end, side='left')
+            if lo < hi:
+                pieces.append(frame.iloc[lo:hi])
+        if not pieces:
+            return self.empty()
+        # A single piece is a slice of the store, more pieces need a copy.
+        return pieces[0] if len(pieces) == 1 else pd.concat(union_categories(pieces))
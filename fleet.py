@@ -0,0 +1,31 @@
+# encoding=utf-8
+
+import numpy as np
+
+from rollup import HOURS
+
+
+def partition(items, size):
+    """ Return items split into lists of at most size. """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def summarize_fleet(rollup, machines, day):
+    """ Return a dict of 'counts', 'revenue' (hour x flavor) and 'machine_revenue'
+    of machines on day. The (hour x flavor) arrays of the machines are stacked
+    and summed in one pass, which is a few ms for thousands of machines. Low
+    tanks are alerts.get_alerts of a forecaster checkpoint. """
+    keys = [(mach_num, day) for mach_num in machines if (mach_num, day) in rollup.counts]
+    if not keys:
+        return {
+            'counts': np.zeros((HOURS, len(rollup.flavors)), dtype=np.int64),
+            'revenue': np.zeros((HOURS, len(rollup.flavors)), dtype=np.int64),
+            'machine_revenue': dict()
+        }
+    revenue = np.stack([rollup.revenue[key] for key in keys])
+    machine_revenue = revenue.sum(axis=(1, 2))
+    return {
+        'counts': np.stack([rollup.counts[key] for key in keys]).sum(axis=0),
+        'revenue': revenue.sum(axis=0),
+        'machine_revenue': {mach_num: int(value) for (mach_num, _), value in zip(keys, machine_revenue)}
+    }
@@ -0,0 +1,155 @@
+# encoding=utf-8
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import connector
+import snapshot
+from simulation import FleetSimulator, BUSINESS_HOUR, TICK, to_table_rows
+from statelog import thin_states
+
+# Relative demand of each hour, with peaks at morning, lunch and afternoon.
+HOURLY_DEMAND = {
+    7: .3, 8: .7, 9: 1., 10: .9, 11: .7, 12: 1., 13: .9, 14: .6,
+    15: .7, 16: .6, 17: .5, 18: .4, 19: .3, 20: .2, 21: .1, 22: .1
+}
+WEEKEND_DEMAND = 1.2  # Ratio of weekend demand to weekday demand.
+CUPS_PER_DAY = 120  # Average cups a machine sells per day.
+TABLES = {'order': 'machine_order', 'state': 'machine_state', 'refill': 'machine_refill'}
+
+
+def make_fleet(shops, machines_per_shop):
+    """ Return a list of (shop, mach_num) of a fleet. """
+    return [(f'Shop {s:03d}', f'CM-{s * machines_per_shop + m:05d}')
+            for s in range(shops) for m in range(machines_per_shop)]
+
+
+class DemandModel:
+    """ Expected orders per tick of every machine and flavor.
+
+    Each machine has a popularity and a flavor mix, and the demand of an
+    hour follows HOURLY_DEMAND within the business hour.
+    """
+
+    def __init__(self, size, flavors, cups_per_day=CUPS_PER_DAY, business_hour=BUSINESS_HOUR,
+                 tick=TICK, seed=None):
+        rng = np.random.default_rng(seed)
+        popularity = rng.lognormal(0, .4, size)
+        mix = rng.dirichlet(np.full(flavors, 4.), size)
+        self.base = cups_per_day * popularity[:, None] * mix  # cups per day, (machine x flavor)
+        hours = range(business_hour['open'].hour, business_hour['close'].hour)
+        total = sum(HOURLY_DEMAND.get(h, 0) for h in hours)
+        self.weights = {h: HOURLY_DEMAND.get(h, 0) / total for h in hours}
+        self.ticks_per_hour = 3600 / tick
+        self.day_factor = 1.
+
+    def for_day(self, day):
+        """ Set the day, which weekends sell more. """
+        self.day_factor = WEEKEND_DEMAND if day.weekday() >= 5 else 1.
+        return self
+
+    def __call__(self, hour):
+        return self.base * (self.day_factor * self.weights.get(hour, 0) / self.ticks_per_hour)
+
+
+def open_database(backend, database):
+    """ Return a connection tuned for bulk loading, or None without backend. """
+    if backend == 'sqlite':
+        conn = sqlite3.connect(database)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        return conn
+    if backend == 'postgres':
+        return psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
+    return None
+
+
+def write_tables(conn, backend, result, batch_size):
+    """ Write a day of simulated tables to database. """
+    for key, table in TABLES.items():
+        rows = to_table_rows(result[key])
+        if backend == 'sqlite':
+            connector.write_to_sqlite(conn, table, rows, batch_size)
+        else:
+            connector.copy_to_postgres(conn, table, rows)
+
+
+def generate(shops, machines_per_shop, days, start_day, backend='sqlite', database=connector.DATABASE_NAME,
+             snapshot_dir=None, cups_per_day=CUPS_PER_DAY, batch_size=connector.CHUNK_SIZE, seed=None,
+             state_freq=None):
+    """ Simulate a fleet, and load the result into database and/or a snapshot.
+    Return a dict of row counts of each table.
+
+    :param state_freq: keep state rows only on its boundaries, e.g. '1h',
+        as statelog.StateEngine rebuilds the others from orders and refills.
+    """
+    fleet = make_fleet(shops, machines_per_shop)
+    sim = FleetSimulator(fleet, seed=seed)
+    demand = DemandModel(len(fleet), len(sim.recipes), cups_per_day, seed=seed)
+    counts = {key: 0 for key in TABLES}
+    frames = {key: [] for key in TABLES}
+
+    conn = open_database(backend, database)
+    try:
+        if conn is not None:
+            connector.create_tables(conn)
+        for day in (start_day + timedelta(days=i) for i in range(days)):
+            result = sim.run_day(day, demand.for_day(day))
+            if state_freq is not None:
+                result['state'] = thin_states(result['state'], state_freq)
+            for key in counts:
+                counts[key] += len(result[key])
+            if conn is not None:
+                write_tables(conn, backend, result, batch_size)
+            if snapshot_dir is not None:
+                for key in frames:
+                    frames[key].append(result[key])
+            print(f"{day}: {len(result['order'])} orders, {len(result['state'])} states, "
+                  f"{len(result['refill'])} refills")
+        if conn is not None:
+            connector.create_indexes(conn)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if snapshot_dir is not None:
+        data = {key: pd.concat(frames[key], ignore_index=True)
+                .sort_values(['mach_num', 'datetime'], kind='mergesort').reset_index(drop=True)
+                for key in frames}
+        snapshot.save_snapshot(data, snapshot_dir)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate coffee machine data of a simulated fleet.')
+    parser.add_argument('--shops', type=int, default=3)
+    parser.add_argument('--machines-per-shop', type=int, default=3)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--start', type=date.fromisoformat, default=date(2021, 1, 1), help='YYYY-MM-DD')
+    parser.add_argument('--cups-per-day', type=float, default=CUPS_PER_DAY)
+    parser.add_argument('--backend', choices=['sqlite', 'postgres', 'none'], default='sqlite')
+    parser.add_argument('--database', default=connector.DATABASE_NAME, help='sqlite file')
+    parser.add_argument('--snapshot', default=None, help='also save a snapshot to this directory')
+    parser.add_argument('--batch-size', type=int, default=connector.CHUNK_SIZE)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--state-freq', default=None,
+                        help="keep state rows only every e.g. '1h', for STATE_SOURCE=events")
+    args = parser.parse_args()
+
+    tick = time.perf_counter()
+    counts = generate(args.shops, args.machines_per_shop, args.days, args.start,
+                      backend=None if args.backend == 'none' else args.backend, database=args.database,
+                      snapshot_dir=args.snapshot, cups_per_day=args.cups_per_day,
+                      batch_size=args.batch_size, seed=args.seed, state_freq=args.state_freq)
+    print(f"Done in {time.perf_counter() - tick:.1f}s:", ', '.join(f'{k} {v} rows' for k, v in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# encoding=utf-8
+
+import numpy as np
+import pandas as pd
+
+MAX_POINTS = 1000  # Points of a series sent to a chart.
+
+
+def lttb(x, y, n):
+    """ Return indices of n points of (x, y), chosen by Largest-Triangle-
+    Three-Buckets, which keeps the visual shape of a line. x is sorted. """
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:n], dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # The first and last points are kept, others are split into n - 2 buckets.
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    index = np.empty(n, dtype=np.int64)
+    index[0], index[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else size
+        cx, cy = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        # Twice the area of triangles of the last chosen point, a candidate
+        # and the mean of the next bucket.
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        index[i + 1] = a
+    return index
+
+
+def minmax(y, n):
+    """ Return sorted indices of the minimum and maximum of y in n // 2
+    buckets, which keeps every peak and dip. """
+    size = len(y)
+    buckets = max(n // 2, 1)
+    if n >= size:
+        return np.arange(size)
+    y = np.asarray(y)
+    edges = np.linspace(0, size, buckets + 1).astype(np.int64)
+    index = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if lo < hi:
+            index.extend([lo + int(np.argmin(y[lo:hi])), lo + int(np.argmax(y[lo:hi]))])
+    return np.unique(index)
+
+
+def downsample(times, values, max_points=MAX_POINTS, method='lttb'):
+    """ Return (times, values) of at most max_points, by 'lttb' or 'minmax'. """
+    if len(times) <= max_points:
+        return times, values
+    if method == 'lttb':
+        index = lttb(np.asarray(times).view(np.int64), values, max_points)
+    elif method == 'minmax':
+        index = minmax(values, max_points)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    return times[index], values[index]
+
+
+def get_state_history(store, mach_num, start_dt, end_dt, columns, max_points=MAX_POINTS, method='lttb'):
+    """ Return a long dataframe of 'datetime', 'column' and 'value' of a
+    machine's states, each column downsampled to at most max_points. """
+    df = store.read(mach_num, start_dt, end_dt)
+    times = df['datetime'].to_numpy()
+    frames = []
+    for col in columns:
+        x, y = downsample(times, df[col].to_numpy(), max_points, method)
+        frames.append(pd.DataFrame({'datetime': x, 'column': col, 'value': y}))
+    return pd.concat(frames, ignore_index=True)
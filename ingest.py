@@ -0,0 +1,139 @@
+# encoding=utf-8
+
+from collections import Counter
+from functools import partial
+import threading
+
+import numpy as np
+import pandas as pd
+
+import connector
+from schema import prepare_table
+
+INGEST_INTERVAL = 60  # sec
+ROWID_COLUMN = '_rowid_'
+
+
+def row_tuples(df):
+    """ Return rows of df as tuples of their values, in order of column names. """
+    columns = sorted(col for col in df.columns if col != ROWID_COLUMN)
+    return list(df[columns].itertuples(index=False, name=None))
+
+
+def drop_seen(df, seen, at):
+    """ Return rows of df without those in seen, a Counter of rows of
+    datetime at which were handed on before. Each seen row drops one equal
+    row, so rows that repeat, e.g. two equal orders in a second, are kept. """
+    if not seen or at is None:
+        return df
+    same = np.flatnonzero((df['datetime'] == at).to_numpy())
+    left = Counter(seen)
+    drop = []
+    for i, row in zip(same, row_tuples(df.iloc[same])):
+        if left[row] > 0:
+            left[row] -= 1
+            drop.append(i)
+    return df.drop(df.index[drop]) if drop else df
+
+
+class TailIngestor:
+    """ Poll tables for rows after a watermark, and hand only those rows on.
+
+    The watermark of a table is its latest datetime, and on sqlite also its
+    largest rowid, which does not miss rows inserted late with an old time.
+    Polls by datetime read rows at or after the watermark, so rows arriving
+    late with the watermark's own time are not missed, and drop the rows of
+    that time which were handed on before. Each poll reads the delta with a
+    pushed-down filter, so its cost is proportional to the new rows, not to
+    the table.
+    """
+
+    def __init__(self, tables, on_rows, watermarks=None, backend=None, watermark_rows=None):
+        """
+        :param tables: a dict of {key: table_name}, e.g. {'order': 'machine_order'}.
+        :param on_rows: a function called as on_rows(key, df) with new rows.
+        :param watermarks: a dict of {key: datetime}, which rows are loaded until.
+        :param watermark_rows: a dict of {key: dataframe} of the loaded rows
+            at the watermark, which are not handed on again.
+        """
+        self.tables = tables
+        self.on_rows = on_rows
+        self.backend = connector.DATABASE_BACKEND if backend is None else backend
+        watermarks = dict() if watermarks is None else watermarks
+        watermark_rows = dict() if watermark_rows is None else watermark_rows
+        self.watermarks = dict()
+        for key in tables:
+            self.set_watermark(key, watermarks.get(key), watermark_rows.get(key))
+        self.last_poll = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_watermark(self, key, latest, rows=None):
+        """ Set the watermark of a table to datetime latest, rows are the
+        loaded rows of the table at latest. """
+        seen = Counter() if rows is None else Counter(row_tuples(rows[rows['datetime'] == latest]))
+        self.watermarks[key] = {'datetime': latest, 'rowid': None, 'seen': seen}
+
+    def read_delta(self, key):
+        """ Return rows of a table after its watermark, in the compact schema. """
+        watermark = self.watermarks[key]
+        if self.backend == 'sqlite':
+            if watermark['rowid'] is not None:
+                filters = {'after_rowid': watermark['rowid']}
+            else:
+                filters = {'since': watermark['datetime']}
+            df = connector.read_table(self.tables[key], f'rowid AS {ROWID_COLUMN}, *',
+                                      backend='sqlite', **filters)
+        else:
+            df = connector.read_table(self.tables[key], backend=self.backend,
+                                      since=watermark['datetime'])
+        if df is None:
+            raise IOError(f"Fail to read {self.tables[key]}.")
+        return prepare_table(df, key)
+
+    def poll(self):
+        """ Read new rows of every table, and return {key: number of new rows}.
+        Tables are read concurrently, and rows are handed on in table order. """
+        counts = dict()
+        deltas = connector.run_concurrently({key: partial(self.read_delta, key) for key in self.tables})
+        for key in self.tables:
+            df = deltas[key]
+            watermark = self.watermarks[key]
+            by_rowid = self.backend == 'sqlite' and watermark['rowid'] is not None
+            if len(df) and ROWID_COLUMN in df:
+                watermark['rowid'] = int(df[ROWID_COLUMN].max())
+                df = df.drop([ROWID_COLUMN], axis=1)
+            if not by_rowid:
+                df = drop_seen(df, watermark['seen'], watermark['datetime'])
+            counts[key] = len(df)
+            if not len(df):
+                continue
+            latest = df['datetime'].max()
+            if watermark['datetime'] is None or latest > watermark['datetime']:
+                watermark['datetime'] = latest
+                watermark['seen'] = Counter()
+            if latest == watermark['datetime']:
+                watermark['seen'].update(row_tuples(df[df['datetime'] == latest]))
+            self.on_rows(key, df)
+        self.last_poll = pd.Timestamp.now()
+        return counts
+
+    def run(self, interval=INGEST_INTERVAL, on_poll=None):
+        """ Poll until stop() is called, on_poll(counts) is called after each poll. """
+        while not self._stop.is_set():
+            try:
+                counts = self.poll()
+                if on_poll is not None:
+                    on_poll(counts)
+            except Exception as error:
+                print(f'Ingestion failed: {error!r}')
+            self._stop.wait(interval)
+
+    def start(self, interval=INGEST_INTERVAL, on_poll=None):
+        """ Run the polling loop in a daemon thread. """
+        self._thread = threading.Thread(target=self.run, args=(interval, on_poll), daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,204 @@
+# encoding=utf-8
+
+from collections import deque
+import functools
+import json
+import threading
+import time
+
+import flask
+import dash
+from dash.dependencies import handle_callback_args
+from dash.exceptions import PreventUpdate
+
+# Upper bounds of the latency histogram, in seconds.
+DURATION_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.]
+SLOW_LOG_SIZE = 100  # Latest slow calls kept in memory.
+DASH_UPDATE_PATH = '_dash-update-component'
+
+
+def get_output_id(args, kwargs):
+    """ Return the id Dash gives a callback of app.callback arguments, which
+    the page sends back as 'output' of each update request. """
+    output = handle_callback_args(args, kwargs)[0]
+    if isinstance(output, (list, tuple)):
+        return '..' + '...'.join(f'{o.component_id}.{o.component_property}' for o in output) + '..'
+    return f'{output.component_id}.{output.component_property}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CallbackStats:
+    """ Counters and a latency histogram of one registered callback. """
+
+    def __init__(self, name, output_id):
+        self.name = name
+        self.output_id = output_id
+        self.calls = 0
+        self.prevented = 0
+        self.errors = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration_sum = 0.
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.requests = 0
+
+    def observe(self, duration, outcome):
+        self.calls += 1
+        self.duration_sum += duration
+        if outcome == 'prevented':
+            self.prevented += 1
+        elif outcome == 'error':
+            self.errors += 1
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class CallbackMetrics:
+    """ Instrument every callback of a Dash app, and render the numbers in
+    the Prometheus text format.
+
+    instrument(app) replaces app.callback, so callbacks registered after it
+    are wrapped with a timer which counts calls, PreventUpdate and errors.
+    Payload sizes are taken from the update requests and responses Dash
+    already serializes, so they cost nothing extra. Calls slower than
+    `slow_threshold` seconds are printed with the triggering inputs.
+    """
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.slow_calls = deque(maxlen=SLOW_LOG_SIZE)
+        self.stats = dict()  # {output_id: CallbackStats}
+        self.gauges = dict()  # {name: (help, func)}
+        self._lock = threading.Lock()
+
+    def instrument(self, app):
+        """ Wrap app.callback, and record payload sizes on app.server. """
+        register = app.callback
+
+        @functools.wraps(register)
+        def callback(*args, **kwargs):
+            decorator = register(*args, **kwargs)
+            output_id = get_output_id(args, kwargs)
+
+            def wrap(func):
+                return decorator(self.wrap(func, output_id))
+
+            return wrap
+
+        app.callback = callback
+        app.server.after_request(self.record_payload)
+        return app
+
+    def wrap(self, func, output_id):
+        """ Return func timed under the name of output_id. """
+        with self._lock:
+            stats = self.stats.setdefault(output_id, CallbackStats(func.__name__, output_id))
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            outcome = 'ok'
+            tick = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except PreventUpdate:
+                outcome = 'prevented'
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                duration = time.perf_counter() - tick
+                with self._lock:
+                    stats.observe(duration, outcome)
+                if self.slow_threshold is not None and duration >= self.slow_threshold:
+                    self.log_slow_call(stats, duration, outcome)
+
+        return timed
+
+    def log_slow_call(self, stats, duration, outcome):
+        """ Keep and print a slow call, with what triggered it. """
+        triggered = None
+        if flask.has_request_context():
+            triggered = dash.callback_context.triggered
+        entry = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'callback': stats.name,
+            'output': stats.output_id,
+            'duration_ms': round(duration * 1000, 1),
+            'outcome': outcome,
+            'triggered': triggered
+        }
+        self.slow_calls.append(entry)
+        print(f'Slow callback: {json.dumps(entry, default=str)}')
+
+    def record_payload(self, response):
+        """ Add the request and response bytes of a Dash update to its callback. """
+        if flask.request.path.endswith(DASH_UPDATE_PATH):
+            body = flask.request.get_json(silent=True) or dict()
+            stats = self.stats.get(body.get('output'))
+            if stats is not None:
+                with self._lock:
+                    stats.requests += 1
+                    stats.request_bytes += flask.request.content_length or 0
+                    stats.response_bytes += response.content_length or 0
+        return response
+
+    def add_gauge(self, name, help_text, func):
+        """ Also render func() as gauge name, e.g. a cache size. """
+        self.gauges[name] = (help_text, func)
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format. """
+        with self._lock:
+            stats = [(s, list(s.buckets)) for s in self.stats.values()]
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def labels(s, **extra):
+            items = {'callback': s.name, 'output': s.output_id, **extra}
+            return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in items.items()) + '}'
+
+        for name, attr, help_text in [
+            ('dash_callback_calls_total', 'calls', 'Calls of a callback.'),
+            ('dash_callback_prevented_total', 'prevented', 'Calls which raised PreventUpdate.'),
+            ('dash_callback_errors_total', 'errors', 'Calls which raised an error.'),
+        ]:
+            family(name, 'counter', help_text)
+            lines.extend(f'{name}{labels(s)} {getattr(s, attr)}' for s, _ in stats)
+
+        name = 'dash_callback_duration_seconds'
+        family(name, 'histogram', 'Wall time of a callback.')
+        for s, buckets in stats:
+            count = 0
+            for bound, n in zip(DURATION_BUCKETS, buckets):
+                count += n
+                lines.append(f'{name}_bucket{labels(s, le=bound)} {count}')
+            lines.append(f'{name}_bucket{labels(s, le="+Inf")} {s.calls}')
+            lines.append(f'{name}_sum{labels(s)} {s.duration_sum:.6f}')
+            lines.append(f'{name}_count{labels(s)} {s.calls}')
+
+        for name, attr, help_text in [
+            ('dash_callback_request_bytes', 'request_bytes', 'Serialized inputs of update requests.'),
+            ('dash_callback_response_bytes', 'response_bytes', 'Serialized outputs of update responses.'),
+        ]:
+            family(name, 'summary', help_text)
+            for s, _ in stats:
+                lines.append(f'{name}_sum{labels(s)} {getattr(s, attr)}')
+                lines.append(f'{name}_count{labels(s)} {s.requests}')
+
+        for name, (help_text, func) in self.gauges.items():
+            family(name, 'gauge', help_text)
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+    def response(self):
+        """ A Flask view of render(). """
+        return flask.Response(self.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,277 @@
+# encoding=utf-8
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import shutil
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from coffeemachine import Menu
+from datastore import MachineStore
+from fleet import partition
+from rollup import SALES_TARGET
+from simulation import INGREDIENTS, get_recipe_matrix
+
+REPORTS = ['machine_daily', 'shop_daily', 'refills']
+FORMATS = ['csv', 'parquet']
+SHARD_SHOPS = 8  # Shops exported by one task, a shop and its machines are in the same task.
+POOL_WORKERS = os.cpu_count() or 1
+
+_worker = dict()  # Stores of a worker process, see init_worker.
+
+
+def get_machine_report(orders, refills, start_day, end_day, flavors, prices, target=SALES_TARGET):
+    """ Return a dataframe of a machine's days from start_day to end_day:
+    'date', a count column per flavor, 'cups', 'revenue', 'target' and
+    'target_ratio', and with refills, 'refills' and a summed column per
+    ingredient, e.g. 'refill_water'. Days are counted by bincount, so a
+    month of a machine is a few array operations. """
+    start = np.datetime64(start_day, 'D')
+    days = (np.datetime64(end_day, 'D') - start).astype(np.int64) + 1
+    index = (orders['datetime'].to_numpy().astype('datetime64[D]') - start).astype(np.int64)
+    codes = pd.Categorical(orders['flavor'], categories=flavors).codes
+    keep = (codes >= 0) & (index >= 0) & (index < days)
+    counts = np.bincount(index[keep] * len(flavors) + codes[keep],
+                         minlength=days * len(flavors)).reshape(days, len(flavors))
+    df = pd.DataFrame(counts, columns=flavors)
+    df.insert(0, 'date', pd.date_range(start_day, periods=days).date)
+    df['cups'] = counts.sum(axis=1)
+    df['revenue'] = counts @ np.asarray(prices, dtype=np.int64)
+    df['target'] = target
+    df['target_ratio'] = (df['revenue'] / target).round(3)
+    if refills is not None:
+        index = (refills['datetime'].to_numpy().astype('datetime64[D]') - start).astype(np.int64)
+        keep = (index >= 0) & (index < days)
+        df['refills'] = np.bincount(index[keep], minlength=days)
+        for name in INGREDIENTS:
+            amounts = refills[name].to_numpy(dtype=np.int64)[keep]
+            df[f'refill_{name}'] = np.bincount(index[keep], weights=amounts, minlength=days).astype(np.int64)
+    return df
+
+
+def get_shop_report(shop, machine_df):
+    """ Return the daily report of a shop, the sum of its machine reports,
+    against the target of all its machines. """
+    sums = machine_df.drop(columns=['shop', 'mach_num', 'target_ratio']).groupby('date', sort=True).sum()
+    df = sums.reset_index()
+    df.insert(1, 'shop', shop)
+    df.insert(2, 'machines', machine_df['mach_num'].nunique())
+    df['target'] = SALES_TARGET * df['machines']
+    df['target_ratio'] = (df['revenue'] / df['target']).round(3)
+    columns = [col for col in machine_df.columns if col not in ('date', 'shop', 'mach_num')]
+    return df[['date', 'shop', 'machines'] + columns]
+
+
+def iter_reports(order_store, refill_store, shops, start_day, end_day, menu):
+    """ Yield (shop, {report name: dataframe}) a shop at a time, so only one
+    shop's reports are in memory.
+
+    :param order_store: a MachineStore of orders.
+    :param refill_store: a MachineStore of refills, or None, which leaves
+        out refill columns and events.
+    :param shops: a dict of {shop: [mach_num]}.
+    """
+    flavors = [choice.value for choice in menu.Choices]
+    _, prices = get_recipe_matrix(menu)
+    start_dt = pd.Timestamp(start_day)
+    end_dt = pd.Timestamp(end_day) + pd.Timedelta(days=1)
+    for shop, machines in shops.items():
+        machine_frames, refill_frames = [], []
+        for mach_num in machines:
+            orders = order_store.read(mach_num, start_dt, end_dt)
+            refills = None if refill_store is None else refill_store.read(mach_num, start_dt, end_dt)
+            df = get_machine_report(orders, refills, start_day, end_day, flavors, prices)
+            df.insert(1, 'shop', shop)
+            df.insert(2, 'mach_num', mach_num)
+            machine_frames.append(df)
+            if refills is not None and len(refills):
+                refill_frames.append(pd.DataFrame({
+                    'datetime': refills['datetime'].to_numpy(), 'shop': shop, 'mach_num': mach_num,
+                    **{name: refills[name].to_numpy() for name in INGREDIENTS}}))
+        if not machine_frames:
+            continue
+        machine_df = pd.concat(machine_frames, ignore_index=True)
+        refill_df = pd.concat(refill_frames, ignore_index=True) if refill_frames else pd.DataFrame(
+            columns=['datetime', 'shop', 'mach_num'] + INGREDIENTS)
+        yield shop, {'machine_daily': machine_df, 'shop_daily': get_shop_report(shop, machine_df),
+                     'refills': refill_df}
+
+
+class PartWriter:
+    """ Append dataframes to one file, as CSV or Parquet, without keeping
+    them, so a writer holds at most the chunk being written. """
+
+    def __init__(self, path, fmt='csv'):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown report format: {fmt}")
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, df):
+        if not len(df):
+            return
+        if self.fmt == 'csv':
+            if self._file is None:
+                self._file = open(self.path, 'w', newline='')
+            df.to_csv(self._file, header=self.rows == 0, index=False)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            # Shops and machines are strings, categories differ from chunk to chunk.
+            df = df.astype({col: str for col in ('shop', 'mach_num', 'date') if col in df})
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def get_fleet(df):
+    """ Return a dict of {shop: [mach_num]} of a table, e.g. orders. """
+    pairs = df[['shop', 'mach_num']].drop_duplicates().astype(str).sort_values(['shop', 'mach_num'])
+    return {shop: list(group['mach_num']) for shop, group in pairs.groupby('shop', sort=True)}
+
+
+def init_worker(snapshot_dir):
+    """ Map the snapshot in a worker process. Its pages are shared by all
+    workers, so a worker adds little memory of its own. """
+    import snapshot
+
+    data, _ = snapshot.load_snapshot(snapshot_dir)
+    _worker['order'] = MachineStore(data['order'])
+    _worker['refill'] = MachineStore(data['refill']) if 'refill' in data else None
+    _worker['menu'] = Menu()
+
+
+def write_shop_figure(df, path):
+    """ Write an HTML figure of a shop's daily revenue against its target. """
+    import plotly.express as px
+
+    fig = px.bar(df, x='date', y='revenue', title=f"{df['shop'].iloc[0]} revenue")
+    fig.add_scatter(x=df['date'], y=df['target'], mode='lines', name='Target', line={'color': 'salmon'})
+    fig.write_html(path, include_plotlyjs='cdn')
+
+
+def export_shard(shard, shops, start_day, end_day, out_dir, fmt='csv', figures=False):
+    """ Write the reports of shops to part files of the shard, in a worker
+    process, and return a dict of rows written by report name. """
+    writers = {name: PartWriter(os.path.join(out_dir, name, f'part-{shard:05d}.{fmt}'), fmt) for name in REPORTS}
+    try:
+        for shop, reports in iter_reports(_worker['order'], _worker['refill'], shops, start_day, end_day,
+                                          _worker['menu']):
+            for name, df in reports.items():
+                writers[name].write(df)
+            if figures:
+                write_shop_figure(reports['shop_daily'],
+                                  os.path.join(out_dir, 'figures', f"{shop.replace(' ', '_')}.html"))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {name: writer.rows for name, writer in writers.items()}
+
+
+def merge_parts(out_dir, name):
+    """ Concatenate the CSV part files of a report into out_dir/name.csv, a
+    block at a time, keeping the header of the first part only. """
+    parts = sorted(glob.glob(os.path.join(out_dir, name, 'part-*.csv')))
+    with open(os.path.join(out_dir, f'{name}.csv'), 'wb') as out:
+        for i, part in enumerate(parts):
+            with open(part, 'rb') as f:
+                if i:
+                    f.readline()
+                shutil.copyfileobj(f, out)
+    shutil.rmtree(os.path.join(out_dir, name))
+
+
+def export_reports(snapshot_dir, start_day, end_day, out_dir, fmt='csv', shops=None, workers=POOL_WORKERS,
+                   shard_shops=SHARD_SHOPS, figures=False):
+    """ Export the reports of days from start_day to end_day, which shards of
+    shops are written by a process pool. CSV parts are merged into one file
+    per report, Parquet parts are kept as a dataset directory per report.
+    Return a dict of rows written by report name. """
+    import snapshot
+
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError as err:
+            raise ImportError(f"{err}, install pyarrow to export Parquet.")
+    data, _ = snapshot.load_snapshot(snapshot_dir)
+    if data is None:
+        raise IOError(f"No snapshot in {snapshot_dir}, see generator.py.")
+    fleet = get_fleet(data['order'])
+    if shops:
+        fleet = {shop: fleet[shop] for shop in shops if shop in fleet}
+    for name in REPORTS:
+        shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+        os.makedirs(os.path.join(out_dir, name))
+    if figures:
+        os.makedirs(os.path.join(out_dir, 'figures'), exist_ok=True)
+
+    totals = dict.fromkeys(REPORTS, 0)
+    shards = partition(list(fleet.items()), shard_shops)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(snapshot_dir,)) as pool:
+        futures = [pool.submit(export_shard, i, dict(shard), start_day, end_day, out_dir, fmt, figures)
+                   for i, shard in enumerate(shards)]
+        for done, future in enumerate(as_completed(futures), 1):
+            for name, rows in future.result().items():
+                totals[name] += rows
+            print(f"\r{done}/{len(shards)} shards", end='', flush=True)
+    print()
+    if fmt == 'csv':
+        for name in REPORTS:
+            merge_parts(out_dir, name)
+    return totals
+
+
+def main():
+    import snapshot
+
+    parser = argparse.ArgumentParser(description='Export daily reports of machines and shops: flavor counts, '
+                                                 'revenue against the target and tank refills.')
+    parser.add_argument('--snapshot', default=snapshot.SNAPSHOT_DIR, help='a snapshot, see generator.py')
+    parser.add_argument('--start', type=date.fromisoformat, help='first day, the month of --end by default')
+    parser.add_argument('--end', type=date.fromisoformat, help='last day, the latest day of orders by default')
+    parser.add_argument('--shops', nargs='+', help='shops to export, all shops by default')
+    parser.add_argument('--out', default='reports', help='output directory')
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='parquet needs pyarrow')
+    parser.add_argument('--workers', type=int, default=POOL_WORKERS)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SHOPS, help='shops exported by one task')
+    parser.add_argument('--figures', action='store_true', help='also write an HTML revenue figure per shop')
+    args = parser.parse_args()
+
+    end_day = args.end
+    if end_day is None:
+        data, _ = snapshot.load_snapshot(args.snapshot)
+        if data is None:
+            raise SystemExit(f"No snapshot in {args.snapshot}, see generator.py.")
+        end_day = data['order']['datetime'].max().date()
+    start_day = args.start or end_day.replace(day=1)
+    if start_day > end_day:
+        raise SystemExit(f"--start {start_day} is after --end {end_day}.")
+    tick = time.perf_counter()
+    try:
+        totals = export_reports(args.snapshot, start_day, end_day, args.out, args.format, args.shops, args.workers,
+                                args.shard_size, args.figures)
+    except (ImportError, IOError) as err:
+        raise SystemExit(err)
+    print(f"{start_day} to {end_day}: " + ', '.join(f'{rows} {name} rows' for name, rows in totals.items())
+          + f" in {args.out}, {time.perf_counter() - tick:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# encoding=utf-8
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+HOURS = 24
+SALES_TARGET = 3000  # Daily sales target of a machine, the line of the sales performance figure.
+
+
+class SalesRollup:
+    """ Hourly rollup of flavor sales, keyed by (machine, day, hour, flavor).
+
+    Each (machine, day) holds two (hour x flavor) arrays, the order counts
+    and the revenue. The rollup is built once from machine_order and can be
+    updated with new orders by `add`, so readers never touch raw orders.
+    """
+
+    def __init__(self, menu, df=None):
+        self.menu = menu
+        self.flavors = [choice.value for choice in menu.Choices]
+        self.prices = np.array([menu.cost[choice] for choice in menu.Choices], dtype=np.int64)
+        self.counts = dict()
+        self.revenue = dict()
+        self._lock = threading.Lock()
+        if df is not None:
+            self.add(df)
+
+    def add(self, df):
+        """ Add orders to the rollup, cost is proportional to len(df). """
+        if df is None or not len(df):
+            return
+        codes = pd.Categorical(df['flavor'], categories=self.flavors).codes
+        keep = codes >= 0
+        dt = df['datetime'].dt
+        grouped = pd.DataFrame({
+            'mach_num': df['mach_num'].to_numpy()[keep],
+            'day': dt.date.to_numpy()[keep],
+            'hour': dt.hour.to_numpy()[keep],
+            'flavor': codes[keep]
+        }).groupby(['mach_num', 'day', 'hour', 'flavor']).size()
+
+        with self._lock:
+            for (mach_num, day), part in grouped.groupby(level=[0, 1]):
+                key = (mach_num, day)
+                if key not in self.counts:
+                    self.counts[key] = np.zeros((HOURS, len(self.flavors)), dtype=np.int64)
+                    self.revenue[key] = np.zeros((HOURS, len(self.flavors)), dtype=np.int64)
+                hours = part.index.get_level_values('hour').to_numpy()
+                flavors = part.index.get_level_values('flavor').to_numpy()
+                amounts = part.to_numpy()
+                np.add.at(self.counts[key], (hours, flavors), amounts)
+                np.add.at(self.revenue[key], (hours, flavors), amounts * self.prices[flavors])
+
+    def days(self, mach_num):
+        """ Return days that have orders of the machine. """
+        return sorted(day for mach, day in self.counts if mach == mach_num)
+
+    def get_counts(self, mach_num, day, period=(0, HOURS)):
+        """ Return a (hour x flavor) count array of the hours in period. """
+        counts = self.counts.get((mach_num, day))
+        if counts is None:
+            return np.zeros((period[1] - period[0], len(self.flavors)), dtype=np.int64)
+        return counts[period[0]:period[1]]
+
+    def get_revenue(self, mach_num, day, period=(0, HOURS)):
+        """ Return a (hour x flavor) revenue array of the hours in period. """
+        revenue = self.revenue.get((mach_num, day))
+        if revenue is None:
+            return np.zeros((period[1] - period[0], len(self.flavors)), dtype=np.int64)
+        return revenue[period[0]:period[1]]
+
+    def get_daily(self, mach_num, start_day, end_day):
+        """ Return the days from start_day to end_day, and (day x flavor)
+        count and revenue arrays, the daily tier of the rollup. """
+        days = pd.date_range(start_day, end_day, freq='D').date
+        counts = np.zeros((len(days), len(self.flavors)), dtype=np.int64)
+        revenue = np.zeros_like(counts)
+        for i, day in enumerate(days):
+            if (mach_num, day) in self.counts:
+                counts[i] = self.counts[(mach_num, day)].sum(axis=0)
+                revenue[i] = self.revenue[(mach_num, day)].sum(axis=0)
+        return days, counts, revenue
+
+    def get_hourly(self, mach_num, start_day, end_day):
+        """ Return datetime64 hours from start_day to end_day, and (hour x
+        flavor) count and revenue arrays, the hourly tier of the rollup. """
+        days = pd.date_range(start_day, end_day, freq='D')
+        zeros = np.zeros((HOURS, len(self.flavors)), dtype=np.int64)
+        counts = np.concatenate([self.counts.get((mach_num, day.date()), zeros) for day in days]) \
+            if len(days) else zeros[:0]
+        revenue = np.concatenate([self.revenue.get((mach_num, day.date()), zeros) for day in days]) \
+            if len(days) else zeros[:0]
+        hours = (days.to_numpy()[:, None] + np.arange(HOURS) * np.timedelta64(1, 'h')).ravel()
+        return hours, counts, revenue
+
+    def get_sales_df(self, mach_num, day, period=(9, 21)):
+        """ Return a dataframe like app.get_sales_df, which columns are
+        'time_period', 'flavor', 'amount' and 'sales'. """
+        hours = np.arange(period[0], period[1])
+        counts = self.get_counts(mach_num, day, period)
+        revenue = self.get_revenue(mach_num, day, period)
+        return pd.DataFrame({
+            'time_period': np.repeat(hours, len(self.flavors)),
+            'flavor': np.tile(self.flavors, len(hours)),
+            'amount': counts.ravel(),
+            'sales': revenue.ravel()
+        })
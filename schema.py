@@ -0,0 +1,123 @@
+# encoding=utf-8
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from coffeemachine import Menu
+
+# Compact dtypes of the tables, after 'date' and 'time' become 'datetime'.
+# Tanks hold up to a few thousand ml/g, gauges need no more than float32.
+FLAVOR_DTYPE = pd.CategoricalDtype([choice.value for choice in Menu.Choices])
+SCHEMAS = {
+    'order': {
+        'shop': 'category',
+        'mach_num': 'category',
+        'flavor': FLAVOR_DTYPE,
+        'datetime': 'datetime64[ns]'
+    },
+    'state': {
+        'shop': 'category',
+        'mach_num': 'category',
+        'tank_water': np.int16,
+        'tank_milk': np.int16,
+        'tank_beans': np.int16,
+        'barometer': np.float32,
+        'thermometer': np.float32,
+        'datetime': 'datetime64[ns]'
+    },
+    'refill': {
+        'shop': 'category',
+        'mach_num': 'category',
+        'water': np.int16,
+        'milk': np.int16,
+        'beans': np.int16,
+        'cups': np.int16,
+        'datetime': 'datetime64[ns]'
+    }
+}
+
+
+def parse_datetime(dates, times):
+    """ Return datetime64 values of 'date' and 'time' columns, without
+    concatenating strings. Each distinct date and time is parsed once, and
+    rows are assembled from the parsed values by their codes. """
+    date_codes, date_uniques = pd.factorize(dates)
+    time_codes, time_uniques = pd.factorize(times)
+    days = pd.to_datetime(pd.Index(date_uniques).astype(str)).to_numpy()
+    clocks = pd.to_timedelta(pd.Index(time_uniques).astype(str)).to_numpy()
+    return days[date_codes] + clocks[time_codes]
+
+
+def prepare_table(df, key):
+    """ Return df of table key ('order', 'state' or 'refill') with a 'datetime' column
+    parsed from 'date' and 'time', and columns cast to the compact schema.
+    Columns not in the schema are kept as they are. """
+    df = df.drop(['date', 'time'], axis=1).assign(datetime=parse_datetime(df['date'], df['time']))
+    schema = {col: dtype for col, dtype in SCHEMAS[key].items() if col in df}
+    return df.astype(schema)
+
+
+def union_categories(frames):
+    """ Return frames whose categorical columns share the same categories,
+    so that concatenating them keeps the columns categorical. """
+    frames = list(frames)
+    if len(frames) < 2:
+        return frames
+    for col in frames[0].columns:
+        dtypes = [frame[col].dtype for frame in frames]
+        if not all(isinstance(i, pd.CategoricalDtype) for i in dtypes):
+            continue
+        if all(i == dtypes[0] for i in dtypes):
+            continue
+        categories = pd.Index(pd.unique(np.concatenate([np.asarray(i.categories) for i in dtypes])))
+        frames = [frame.assign(**{col: frame[col].cat.set_categories(categories)}) for frame in frames]
+    return frames
+
+
+def report(df, key):
+    """ Return a dict comparing the raw table with the compact schema:
+    memory in bytes and seconds to parse the datetime column. """
+    tick = time.perf_counter()
+    old = df.copy()
+    old['datetime'] = pd.to_datetime(old['date'] + ' ' + old['time'])
+    old = old.drop(['date', 'time'], axis=1)
+    concat_sec = time.perf_counter() - tick
+
+    tick = time.perf_counter()
+    new = prepare_table(df, key)
+    compact_sec = time.perf_counter() - tick
+
+    old_bytes = int(old.memory_usage(deep=True).sum())
+    new_bytes = int(new.memory_usage(deep=True).sum())
+    return {
+        'table': key,
+        'rows': len(df),
+        'raw_bytes': old_bytes,
+        'compact_bytes': new_bytes,
+        'memory_ratio': round(old_bytes / max(new_bytes, 1), 2),
+        'concat_parse_sec': round(concat_sec, 4),
+        'compact_parse_sec': round(compact_sec, 4),
+        'parse_speedup': round(concat_sec / max(compact_sec, 1e-9), 2)
+    }
+
+
+def main():
+    import connector
+
+    parser = argparse.ArgumentParser(description='Report memory and parse time of the compact table schema.')
+    parser.add_argument('--backend', choices=['sqlite', 'postgres'], default=connector.DATABASE_BACKEND)
+    args = parser.parse_args()
+    for key, table in [('order', 'machine_order'), ('state', 'machine_state')]:
+        df = connector.read_table(table, backend=args.backend)
+        result = report(df, key)
+        print(f"{table}: {result['rows']} rows, "
+              f"{result['raw_bytes'] / 2**20:.1f} MB -> {result['compact_bytes'] / 2**20:.1f} MB "
+              f"(x{result['memory_ratio']}), parse {result['concat_parse_sec']}s -> "
+              f"{result['compact_parse_sec']}s (x{result['parse_speedup']})")
+
+
+if __name__ == '__main__':
+    main()
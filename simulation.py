@@ -0,0 +1,157 @@
+# encoding=utf-8
+
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from coffeemachine import Menu
+from schema import FLAVOR_DTYPE
+
+INGREDIENTS = ['water', 'milk', 'beans', 'cups']
+# Same as the tanks on dashboard, cups are not shown there.
+CAPACITY = {'water': 1600, 'milk': 1200, 'beans': 1000, 'cups': 200}
+REFILL_LEVEL = 0.1  # Refill a machine when any supply is below this ratio of capacity.
+BUSINESS_HOUR = {'open': time(9, 0, 0), 'close': time(21, 0, 0)}
+TICK = 60  # sec
+GAUGES = {'barometer': (9.0, 0.3), 'thermometer': (92.0, 1.5)}  # (mean, std)
+
+
+def get_recipe_matrix(menu):
+    """ Return a (flavor x ingredient) matrix of Menu.recipes, and the price
+    vector of flavors, in order of Menu.Choices and INGREDIENTS. """
+    recipes = np.array([[menu.recipes[choice][i] for i in INGREDIENTS] for choice in menu.Choices],
+                       dtype=np.int64)
+    prices = np.array([menu.cost[choice] for choice in menu.Choices], dtype=np.int64)
+    return recipes, prices
+
+
+class FleetSimulator:
+    """ Simulate N coffee machines at once, as NumPy arrays.
+
+    It runs the same rules as coffeemachine.CoffeeMachine: an order is
+    served only without shortage, it consumes the recipe of Menu.recipes
+    and adds Menu.cost to the money. Supplies of all machines are an
+    (N x ingredient) array, so each tick is a few array operations rather
+    than a loop over machines and orders.
+    """
+
+    def __init__(self, machines, menu=None, capacity=None, refill_level=REFILL_LEVEL, seed=None):
+        """
+        :param machines: a list of (shop, mach_num).
+        :param capacity: a dict of ingredient capacity, default CAPACITY.
+        """
+        self.menu = Menu() if menu is None else menu
+        self.recipes, self.prices = get_recipe_matrix(self.menu)
+        capacity = CAPACITY if capacity is None else capacity
+        self.capacity = np.array([capacity[i] for i in INGREDIENTS], dtype=np.int64)
+        self.refill_level = refill_level
+        self.rng = np.random.default_rng(seed)
+
+        self.shops = pd.Categorical([shop for shop, _ in machines])
+        self.mach_nums = pd.Categorical([mach_num for _, mach_num in machines])
+        self.size = len(machines)
+        self.supplies = np.tile(self.capacity, (self.size, 1))
+        self.money = np.zeros(self.size, dtype=np.int64)
+
+    def serve(self, demand):
+        """ Serve a (machine x flavor) array of ordered amounts, and return
+        the served amounts. Flavors are served in menu order, each one as
+        many as supplies allow. """
+        served = np.zeros_like(demand)
+        for f, recipe in enumerate(self.recipes):
+            used = recipe > 0
+            can = (self.supplies[:, used] // recipe[used]).min(axis=1)
+            served[:, f] = np.minimum(demand[:, f], can)
+            self.supplies -= np.outer(served[:, f], recipe)
+        self.money += served @ self.prices
+        return served
+
+    def refill(self):
+        """ Fill machines that run low back to capacity, and return a
+        (machine x ingredient) array of added amounts. """
+        low = (self.supplies < self.capacity * self.refill_level).any(axis=1)
+        added = np.zeros_like(self.supplies)
+        added[low] = self.capacity - self.supplies[low]
+        self.supplies[low] = self.capacity
+        return added
+
+    def read_gauges(self):
+        """ Return a dict of gauge readings of all machines. """
+        return {name: self.rng.normal(mean, std, self.size).astype(np.float32)
+                for name, (mean, std) in GAUGES.items()}
+
+    def _machine_columns(self, index):
+        return {
+            'shop': pd.Categorical.from_codes(self.shops.codes[index], categories=self.shops.categories),
+            'mach_num': pd.Categorical.from_codes(self.mach_nums.codes[index], categories=self.mach_nums.categories)
+        }
+
+    def run_day(self, day, rates, business_hour=BUSINESS_HOUR, tick=TICK):
+        """ Simulate a day, and return a dict of 'order', 'state' and 'refill'
+        dataframes, shaped like the stored tables (with a 'datetime' column).
+
+        :param rates: a function of (hour) returning a (machine x flavor) array
+            of expected orders per tick, or such an array for the whole day.
+        """
+        start = datetime.combine(day, business_hour['open'])
+        ticks = int((datetime.combine(day, business_hour['close']) - start).total_seconds() // tick)
+        base = np.datetime64(start, 'ns')
+        tick_ns = np.timedelta64(tick, 's').astype('timedelta64[ns]')
+
+        states = np.empty((ticks, self.size, len(INGREDIENTS)), dtype=np.int64)
+        gauges = {name: np.empty((ticks, self.size), dtype=np.float32) for name in GAUGES}
+        served = np.empty((ticks, self.size, len(self.recipes)), dtype=np.int64)
+        refills = np.empty((ticks, self.size, len(INGREDIENTS)), dtype=np.int64)
+        for t in range(ticks):
+            hour = (start + timedelta(seconds=t * tick)).hour
+            rate = rates(hour) if callable(rates) else rates
+            states[t] = self.supplies
+            for name, value in self.read_gauges().items():
+                gauges[name][t] = value
+            served[t] = self.serve(self.rng.poisson(rate, (self.size, len(self.recipes))))
+            refills[t] = self.refill()
+        stamps = base + np.arange(ticks) * tick_ns
+
+        # State rows, one per machine and tick.
+        mach_index = np.tile(np.arange(self.size), ticks)
+        state = pd.DataFrame(self._machine_columns(mach_index))
+        for i, name in enumerate(INGREDIENTS[:3]):
+            state[f'tank_{name}'] = states[:, :, i].ravel().astype(np.int16)
+        for name in GAUGES:
+            state[name] = gauges[name].ravel()
+        state['datetime'] = np.repeat(stamps, self.size)
+
+        # Order rows, each served cup at a random second of its tick.
+        t_idx, m_idx, f_idx = np.nonzero(served)
+        counts = served[t_idx, m_idx, f_idx]
+        t_idx, m_idx, f_idx = (np.repeat(i, counts) for i in (t_idx, m_idx, f_idx))
+        offsets = self.rng.integers(0, tick, len(t_idx)) * np.timedelta64(1, 's')
+        order = pd.DataFrame(self._machine_columns(m_idx))
+        order['flavor'] = pd.Categorical.from_codes(f_idx, dtype=FLAVOR_DTYPE)
+        order['datetime'] = stamps[t_idx] + offsets.astype('timedelta64[ns]')
+        order = order.sort_values('datetime', kind='mergesort').reset_index(drop=True)
+
+        # Refill events, what was added to which machine.
+        t_idx, m_idx = np.nonzero(refills.any(axis=2))
+        refill = pd.DataFrame(self._machine_columns(m_idx))
+        for i, name in enumerate(INGREDIENTS):
+            refill[name] = refills[t_idx, m_idx, i]
+        refill['datetime'] = stamps[t_idx]
+        return {'order': order, 'state': state, 'refill': refill}
+
+    def run(self, start_day, days, rates, business_hour=BUSINESS_HOUR, tick=TICK):
+        """ Yield (day, result of run_day) for each day, supplies carry over. """
+        for i in range(days):
+            day = start_day + timedelta(days=i)
+            yield day, self.run_day(day, rates, business_hour, tick)
+
+
+def to_table_rows(df):
+    """ Return df with 'date' and 'time' string columns in place of
+    'datetime', as machine_order and machine_state store them. """
+    stamps = df['datetime']
+    df = df.drop(['datetime'], axis=1)
+    df.insert(0, 'time', stamps.dt.strftime('%H:%M:%S'))
+    df.insert(0, 'date', stamps.dt.strftime('%Y-%m-%d'))
+    return df
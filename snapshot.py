@@ -0,0 +1,158 @@
+# encoding=utf-8
+
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+APP_PATH = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(APP_PATH, 'data', 'snapshot'))
+META_NAME = 'meta.json'
+CURRENT_NAME = 'CURRENT'
+KEEP_VERSIONS = 2
+
+
+def _save_array(path, array):
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def _write_text(path, text):
+    """ Write a small file, which readers see either whole or not at all. """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def save_table(df, path):
+    """ Save a dataframe as one .npy file per column.
+
+    Datetime columns are saved as int64 nanoseconds, string columns as
+    category codes (the smallest int dtype) with their categories listed
+    in the table meta. Numeric columns keep their dtype.
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            kind, array, categories = 'datetime', series.to_numpy().astype('datetime64[ns]').view(np.int64), None
+        elif pd.api.types.is_numeric_dtype(series):
+            kind, array, categories = 'numeric', series.to_numpy(), None
+        else:
+            cat = pd.Categorical(series)
+            kind, array, categories = 'category', cat.codes, [str(i) for i in cat.categories]
+        _save_array(os.path.join(path, f'{col}.npy'), array)
+        columns.append({'name': col, 'kind': kind, 'categories': categories})
+    return {'rows': len(df), 'columns': columns}
+
+
+def load_table(path, table_meta, mmap_mode=None):
+    """ Return a dataframe from the .npy files saved by save_table.
+
+    With mmap_mode='r' the columns are read-only views of the mapped files,
+    so every process that loads the same snapshot shares its pages.
+    """
+    data = dict()
+    for col in table_meta['columns']:
+        array = np.load(os.path.join(path, f"{col['name']}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+        if col['kind'] == 'datetime':
+            data[col['name']] = array.view('datetime64[ns]')
+        elif col['kind'] == 'category':
+            data[col['name']] = pd.Categorical.from_codes(array, categories=col['categories'])
+        else:
+            data[col['name']] = array
+    return frame_of_columns(data, table_meta['rows'])
+
+
+def frame_of_columns(data, rows):
+    """ Return a dataframe of a dict of column arrays, which keeps the
+    arrays rather than copies. pandas before 2.0 consolidates columns of the
+    same dtype into one new 2-D block even with copy=False, so there the
+    frame is made by frame_of_blocks. """
+    df = pd.DataFrame(data, copy=False)
+    if all(np.shares_memory(df[name].to_numpy(), array) for name, array in data.items()
+           if isinstance(array, np.ndarray)):
+        return df
+    return frame_of_blocks(data, rows)
+
+
+def frame_of_blocks(data, rows):
+    """ Return a dataframe of one block per column array, which pandas does
+    not consolidate until a column is added. """
+    from pandas.core.internals import BlockManager, make_block
+
+    blocks = [make_block(array if isinstance(array, pd.Categorical) else array.reshape(1, -1),
+                         placement=[i], ndim=2) for i, array in enumerate(data.values())]
+    return pd.DataFrame(BlockManager(blocks, [pd.Index(list(data)), pd.RangeIndex(rows)]))
+
+
+def get_watermark(df):
+    """ Return the latest datetime of a table as an ISO string, or None. """
+    if not len(df):
+        return None
+    return pd.Timestamp(df['datetime'].max()).isoformat()
+
+
+def current_version(path=SNAPSHOT_DIR):
+    """ Return the name of the current snapshot version, or None. """
+    try:
+        with open(os.path.join(path, CURRENT_NAME)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def prune_versions(path=SNAPSHOT_DIR, keep=KEEP_VERSIONS):
+    """ Remove old finished versions, except the current one.
+    Processes that still map removed files keep reading them safely. """
+    current = current_version(path)
+    versions = sorted(i for i in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, i, META_NAME)) and i != current)
+    for version in versions[:max(len(versions) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(path, version), ignore_errors=True)
+
+
+def save_snapshot(data, path=SNAPSHOT_DIR):
+    """ Save a dict of table dataframes, e.g. {'order': df, 'state': df},
+    as a new version, then make it current by replacing the CURRENT file. """
+    created = datetime.now()
+    version = f"{created.strftime('%Y%m%d%H%M%S%f')}-{os.getpid()}"
+    version_path = os.path.join(path, version)
+    meta = {'created': created.isoformat(timespec='seconds'), 'version': version, 'tables': dict()}
+    for key, df in data.items():
+        table_meta = save_table(df, os.path.join(version_path, key))
+        table_meta['watermark'] = get_watermark(df)
+        meta['tables'][key] = table_meta
+    # Meta is written last, so a version without it is never read half done.
+    _write_text(os.path.join(version_path, META_NAME), json.dumps(meta))
+    _write_text(os.path.join(path, CURRENT_NAME), version)
+    prune_versions(path)
+    return meta
+
+
+def read_meta(path=SNAPSHOT_DIR, version=None):
+    """ Return the snapshot meta, or None if there is no snapshot. """
+    version = current_version(path) if version is None else version
+    if version is None:
+        return None
+    try:
+        with open(os.path.join(path, version, META_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_snapshot(path=SNAPSHOT_DIR, mmap_mode='r'):
+    """ Return (data, meta) of the current snapshot, or (None, None). """
+    meta = read_meta(path)
+    if meta is None:
+        return None, None
+    data = {key: load_table(os.path.join(path, meta['version'], key), table_meta, mmap_mode)
+            for key, table_meta in meta['tables'].items()}
+    return data, meta
@@ -0,0 +1,201 @@
+# encoding=utf-8
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from datastore import MachineStore, to_stamps
+from simulation import BUSINESS_HOUR, INGREDIENTS, TICK, get_recipe_matrix
+
+SNAPSHOT_FREQ = '1h'  # State rows kept as snapshots, the others are rebuilt from events.
+# The ingredient each tank holds, tanks are not refilled or used otherwise.
+TANK_INGREDIENTS = {'tank_water': 'water', 'tank_milk': 'milk', 'tank_beans': 'beans'}
+
+
+def thin_states(df, freq=SNAPSHOT_FREQ):
+    """ Return the first state row of each machine in each period of freq,
+    e.g. one per hour, which are the snapshots StateEngine starts from.
+    Rows of a machine are expected in order of datetime. """
+    periods = pd.DataFrame({'mach_num': df['mach_num'].to_numpy(),
+                            'period': df['datetime'].dt.floor(freq).to_numpy()})
+    return df[~periods.duplicated().to_numpy()].reset_index(drop=True)
+
+
+class StateEngine:
+    """ Machine states rebuilt from periodic snapshots and the event log.
+
+    Tank levels follow from orders, each of which uses the recipe of its
+    flavor, and refills, which add what they record. So only a snapshot of
+    the states every now and then is stored, and the level at time t is
+
+        snapshot before t + refills in [snapshot, t) - recipes of orders in [snapshot, t)
+
+    For a range of times, the events are one (event x tank) array of signed
+    amounts, and its cumulative sum is looked up by binary search, so a day
+    of a machine is a few array operations. Gauges are not events, they
+    keep the value of the last snapshot.
+
+    It reads like a MachineStore (`read`, `machine_version`), so it stands
+    in for the store of the state table.
+    """
+
+    def __init__(self, snapshots, orders, refills, columns, menu, business_hour=BUSINESS_HOUR, tick=TICK):
+        """
+        :param snapshots: a MachineStore of state rows, e.g. from thin_states().
+        :param orders: a MachineStore of orders.
+        :param refills: a MachineStore of refills, columns are INGREDIENTS.
+        :param columns: state columns of `latest`, e.g. app.STATE_COLUMNS.
+        """
+        self.snapshots = snapshots
+        self.orders = orders
+        self.refills = refills
+        self.columns = list(columns)
+        self.tanks = [col for col in self.columns if col in TANK_INGREDIENTS]
+        self.ingredients = [TANK_INGREDIENTS[col] for col in self.tanks]
+        recipes, _ = get_recipe_matrix(menu)
+        # Amounts each flavor takes from the tanks, (flavor x tank).
+        self.recipes = recipes[:, [INGREDIENTS.index(i) for i in self.ingredients]]
+        self.flavors = [choice.value for choice in menu.Choices]
+        self.open = pd.Timedelta(hours=business_hour['open'].hour, minutes=business_hour['open'].minute)
+        self.close = pd.Timedelta(hours=business_hour['close'].hour, minutes=business_hour['close'].minute)
+        self.tick = pd.Timedelta(seconds=tick)
+
+    @property
+    def latest_event(self):
+        """ Return the latest datetime of any snapshot or event, or None. """
+        times = [store.latest for store in (self.snapshots, self.orders, self.refills) if store.latest is not None]
+        return max(times, default=None)
+
+    def empty(self):
+        return self.snapshots.empty()
+
+    def machine_version(self, mach_num):
+        """ Return a token that changes when the snapshots or events of the machine change. """
+        return '.'.join(store.machine_version(mach_num) for store in (self.snapshots, self.orders, self.refills))
+
+    def get_times(self, start_dt, end_dt):
+        """ Return datetime64 ticks of the business hours where start_dt <= datetime < end_dt. """
+        days = np.arange(np.datetime64(pd.Timestamp(start_dt).normalize(), 'D'),
+                         np.datetime64(pd.Timestamp(end_dt).normalize(), 'D') + 1)
+        offsets = np.arange(self.open.value, self.close.value, self.tick.value).astype('timedelta64[ns]')
+        times = (days.astype('datetime64[ns]')[:, None] + offsets).ravel()
+        return times[(times >= np.datetime64(start_dt, 'ns')) & (times < np.datetime64(end_dt, 'ns'))]
+
+    def get_snapshots(self, mach_num, start_dt, end_dt):
+        """ Return the snapshots of the machine before end_dt, from the last
+        one at or before start_dt. """
+        start = np.datetime64(start_dt, 'ns')
+        before = self.snapshots.read(mach_num, None, start + 1)
+        after = self.snapshots.read(mach_num, start + 1, end_dt)
+        if not len(before):
+            return after
+        return pd.concat([before.iloc[-1:], after]) if len(after) else before.iloc[-1:]
+
+    def get_events(self, mach_num, start_dt, end_dt):
+        """ Return (int64 times, (event x tank) amounts) of orders and refills
+        of the machine where start_dt <= datetime < end_dt, sorted by time. """
+        orders = self.orders.read(mach_num, start_dt, end_dt)
+        refills = self.refills.read(mach_num, start_dt, end_dt)
+        codes = pd.Categorical(orders['flavor'], categories=self.flavors).codes
+        keep = codes >= 0
+        times = np.concatenate([to_stamps(orders['datetime'])[keep], to_stamps(refills['datetime'])])
+        amounts = np.concatenate([-self.recipes[codes[keep]],
+                                  refills[self.ingredients].to_numpy(dtype=np.int64).reshape(-1, len(self.tanks))])
+        order = np.argsort(times, kind='mergesort')
+        return times[order], amounts[order]
+
+    def rebuild(self, mach_num, times):
+        """ Return state rows of the machine at datetime64 times (sorted),
+        like rows of the state table. Times before the first snapshot are left out. """
+        if not len(times):
+            return self.empty()
+        snaps = self.get_snapshots(mach_num, times[0], times[-1] + np.timedelta64(1, 'ns'))
+        if not len(snaps):
+            return self.empty()
+        snap_times = to_stamps(snaps['datetime'])
+        stamps = to_stamps(times)
+        stamps = stamps[stamps >= snap_times[0]]
+        event_times, amounts = self.get_events(mach_num, snaps['datetime'].iloc[0],
+                                               times[-1] + np.timedelta64(1, 'ns'))
+        # total[i] is the sum of the first i events, so events before t sum to total[searchsorted(t)].
+        total = np.zeros((len(event_times) + 1, len(self.tanks)), dtype=np.int64)
+        np.cumsum(amounts, axis=0, out=total[1:])
+        base = np.searchsorted(snap_times, stamps, side='right') - 1
+        levels = (snaps[self.tanks].to_numpy(dtype=np.int64)[base]
+                  + total[np.searchsorted(event_times, stamps, side='left')]
+                  - total[np.searchsorted(event_times, snap_times, side='left')][base])
+        df = snaps.iloc[base].reset_index(drop=True)
+        for i, col in enumerate(self.tanks):
+            df[col] = levels[:, i].astype(snaps[col].dtype)
+        df['datetime'] = stamps.view('datetime64[ns]')
+        return df
+
+    def read(self, mach_num, start_dt=None, end_dt=None):
+        """ Return state rows of the machine at every tick of the business
+        hours where start_dt <= datetime < end_dt, and up to the latest event. """
+        latest = self.latest_event
+        if latest is None or mach_num not in self.snapshots:
+            return self.empty()
+        if start_dt is None:
+            start_dt = self.snapshots.read(mach_num)['datetime'].iloc[0]
+        end_dt = latest + self.tick if end_dt is None else min(pd.Timestamp(end_dt), latest + self.tick)
+        return self.rebuild(mach_num, self.get_times(start_dt, end_dt))
+
+
+def verify(data, freq=SNAPSHOT_FREQ, columns=None):
+    """ Rebuild every state row of data from thin_states(data['state']) and
+    the events, and return a dict of row counts, bytes, seconds and the
+    largest tank difference from the stored rows. """
+    from coffeemachine import Menu
+
+    state = data['state']
+    columns = list(TANK_INGREDIENTS) if columns is None else columns
+    snapshots = thin_states(state, freq)
+    engine = StateEngine(MachineStore(snapshots), MachineStore(data['order']), MachineStore(data['refill']),
+                         columns, Menu())
+    stored = MachineStore(state)
+    tick = time.perf_counter()
+    error = 0
+    for mach_num in stored.machines():
+        expected = stored.read(mach_num)
+        rebuilt = engine.rebuild(mach_num, expected['datetime'].to_numpy())
+        if len(rebuilt) != len(expected):
+            raise ValueError(f"{mach_num}: {len(rebuilt)} rows rebuilt, {len(expected)} stored.")
+        diff = rebuilt[engine.tanks].to_numpy(np.int64) - expected[engine.tanks].to_numpy(np.int64)
+        error = max(error, int(np.abs(diff).max(initial=0)))
+    seconds = time.perf_counter() - tick
+    event_bytes = int(data['refill'].memory_usage(deep=True).sum())
+    return {
+        'state_rows': len(state),
+        'snapshot_rows': len(snapshots),
+        'refill_rows': len(data['refill']),
+        'state_bytes': int(state.memory_usage(deep=True).sum()),
+        'stored_bytes': int(snapshots.memory_usage(deep=True).sum()) + event_bytes,
+        'rebuild_sec': round(seconds, 3),
+        'max_error': error
+    }
+
+
+def main():
+    import snapshot
+
+    parser = argparse.ArgumentParser(description='Rebuild machine states from snapshots and events, '
+                                                 'and compare them with the stored state rows.')
+    parser.add_argument('--snapshot', default=snapshot.SNAPSHOT_DIR,
+                        help='a snapshot with order, state and refill tables, see generator.py')
+    parser.add_argument('--freq', default=SNAPSHOT_FREQ, help='state snapshot frequency, e.g. 1h, 1D')
+    args = parser.parse_args()
+    data, _ = snapshot.load_snapshot(args.snapshot)
+    if data is None or 'refill' not in data:
+        raise SystemExit(f"No snapshot with a refill table in {args.snapshot}.")
+    result = verify(data, args.freq)
+    print(f"state: {result['state_rows']} rows -> {result['snapshot_rows']} snapshots + "
+          f"{result['refill_rows']} refills, {result['state_bytes'] / 2**20:.1f} MB -> "
+          f"{result['stored_bytes'] / 2**20:.1f} MB (x{result['state_bytes'] / max(result['stored_bytes'], 1):.1f}), "
+          f"rebuilt in {result['rebuild_sec']}s, max tank error {result['max_error']}")
+
+
+if __name__ == '__main__':
+    main()
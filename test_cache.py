@@ -0,0 +1,27 @@
+# encoding=utf-8
+
+import numpy as np
+
+from cache import LRUCache, estimate_size
+
+
+def test_entries_are_evicted_by_bytes():
+    cache = LRUCache(maxsize=100, maxbytes=2500)
+    for key in 'abc':
+        cache.put(key, np.zeros(100))  # 800 bytes
+    cache.get('a')
+    cache.put('d', np.zeros(100))
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.nbytes == 2400
+
+    cache.put('e', np.zeros(1000))  # Larger than maxbytes, so only it is kept.
+    assert len(cache) == 1 and cache.nbytes == 8000
+    cache.pop('e')
+    assert cache.nbytes == 0
+
+
+def test_estimate_size_counts_shared_objects_once():
+    array = np.zeros(1000)
+    assert estimate_size({'a': array, 'b': array}) < estimate_size({'a': array, 'b': array.copy()})
+    assert estimate_size([array]) > array.nbytes
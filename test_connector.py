@@ -0,0 +1,34 @@
+# encoding=utf-8
+
+import sqlite3
+
+import pytest
+
+import connector
+
+
+def test_indexes_of_a_database_without_refills(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / connector.DATABASE_NAME))
+    connector.create_tables(conn, ['machine_order', 'machine_state'])
+    connector.create_indexes(conn)
+
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    conn.close()
+    assert {'machine_order_datetime_idx', 'machine_state_datetime_idx'} <= names
+    assert not any(name.startswith('machine_refill') for name in names)
+
+
+def test_query_of_an_empty_machine_list_is_refused():
+    with pytest.raises(ValueError):
+        connector.build_query('machine_order', mach_num=[])
+    query, params = connector.build_query('machine_order', shop='Shop 000')
+    assert query == 'SELECT * FROM machine_order WHERE shop IN (%s)' and params == ('Shop 000',)
+
+
+def test_query_columns_are_identifiers():
+    query, _ = connector.build_query('machine_order', 'rowid AS _rowid, *', placeholder='?')
+    assert query == 'SELECT rowid AS _rowid, * FROM machine_order'
+    assert connector.build_query('machine_order', ['date', 'time'])[0] == 'SELECT date, time FROM machine_order'
+    for columns in ['date; DROP TABLE machine_order', 'date AS', '* AS x', 'COUNT(*)']:
+        with pytest.raises(ValueError):
+            connector.build_query('machine_order', columns)
@@ -0,0 +1,23 @@
+# encoding=utf-8
+
+import pandas as pd
+
+from datastore import MachineStore
+
+
+def make_rows(mach_num, times, **columns):
+    return pd.DataFrame({'shop': 'Shop 000', 'mach_num': mach_num, **columns, 'datetime': pd.to_datetime(times)})
+
+
+def test_late_rows_are_sorted_into_place():
+    store = MachineStore(make_rows('CM-00000', ['2021-01-01 09:00', '2021-01-03 21:00'], flavor=['Latte', 'Latte']))
+    store.append(make_rows('CM-00000', ['2021-01-04 10:00'], flavor=['Espresso']))
+    # A row inserted late, with a time before the machine's last row.
+    store.append(make_rows('CM-00000', ['2021-01-01 12:00'], flavor=['Cappuccino']))
+
+    rows = store.read('CM-00000')
+    assert rows['datetime'].is_monotonic_increasing
+    assert len(rows) == 4
+    assert len(store.read('CM-00000', '2021-01-01', '2021-01-02')) == 2
+    late = store.read('CM-00000', '2021-01-03 20:00', '2021-01-05')
+    assert list(late['datetime']) == list(pd.to_datetime(['2021-01-03 21:00', '2021-01-04 10:00']))
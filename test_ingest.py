@@ -0,0 +1,45 @@
+# encoding=utf-8
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import connector
+from ingest import TailIngestor
+
+
+def make_orders(times, flavor='Latte'):
+    times = pd.to_datetime(times)
+    return pd.DataFrame({'date': times.strftime('%Y-%m-%d'), 'time': times.strftime('%H:%M:%S'),
+                         'shop': 'Shop 000', 'mach_num': 'CM-00000', 'flavor': flavor})
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(connector, '_pools', dict())
+    conn = sqlite3.connect(connector.DATABASE_NAME)
+    connector.create_tables(conn, ['machine_order'])
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'postgres'])
+def test_late_row_with_the_watermark_time_is_ingested(database, monkeypatch, backend):
+    # Polls by datetime, which postgres always uses, run against the sqlite table.
+    read_table = connector.read_table
+    monkeypatch.setattr(connector, 'read_table', lambda *args, backend=None, **kwargs:
+                        read_table(*args, backend='sqlite', **kwargs))
+    received = []
+    ingestor = TailIngestor({'order': 'machine_order'}, lambda key, df: received.append(df), backend=backend)
+
+    connector.write_to_sqlite(database, 'machine_order', make_orders(['2021-01-01 20:59:58', '2021-01-01 20:59:59']))
+    assert ingestor.poll() == {'order': 2}
+    # Another row of the same second arrives after the poll.
+    connector.write_to_sqlite(database, 'machine_order', make_orders(['2021-01-01 20:59:59'], flavor='Espresso'))
+    if backend == 'sqlite':
+        ingestor.watermarks['order']['rowid'] = None  # Poll by datetime, like the first sqlite poll.
+    assert ingestor.poll() == {'order': 1}
+    assert list(received[-1]['flavor']) == ['Espresso']
+    assert ingestor.poll() == {'order': 0}
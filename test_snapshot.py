@@ -0,0 +1,56 @@
+# encoding=utf-8
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import snapshot
+
+
+def make_states():
+    return pd.DataFrame({'shop': 'Shop 000', 'mach_num': ['CM-00000', 'CM-00001', 'CM-00001'],
+                         'tank_water': np.array([100, 90, 80], dtype=np.int16),
+                         'barometer': np.array([9.0, 9.1, 9.2], dtype=np.float32),
+                         'thermometer': np.array([90.0, 91.0, 92.0], dtype=np.float32),
+                         'datetime': pd.to_datetime(['2021-01-01 09:00', '2021-01-01 09:00', '2021-01-01 09:01'])})
+
+
+def is_mapped(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def assert_shared(df, arrays):
+    for name, array in arrays.items():
+        if isinstance(array, pd.Categorical):
+            assert np.shares_memory(df[name].cat.codes.to_numpy(), array.codes)
+        else:
+            assert np.shares_memory(df[name].to_numpy(), array)
+
+
+def test_loaded_columns_are_memory_mapped(tmp_path):
+    states = make_states()
+    snapshot.save_snapshot({'state': states}, str(tmp_path))
+    data, _ = snapshot.load_snapshot(str(tmp_path))
+
+    df = data['state']
+    pd.testing.assert_frame_equal(df.astype({'shop': object, 'mach_num': object}), states)
+    assert all(is_mapped(df[name].to_numpy()) for name in ['tank_water', 'barometer', 'thermometer', 'datetime'])
+    assert all(is_mapped(df[name].cat.codes.to_numpy()) for name in ['shop', 'mach_num'])
+    with pytest.raises(ValueError):
+        df['tank_water'].to_numpy()[0] = 0  # Mapped read-only.
+
+
+@pytest.mark.parametrize('make_frame', [snapshot.frame_of_columns, snapshot.frame_of_blocks])
+def test_frames_keep_the_column_arrays(make_frame):
+    states = make_states()
+    arrays = {'mach_num': pd.Categorical(states['mach_num']), 'tank_water': states['tank_water'].to_numpy(),
+             'barometer': states['barometer'].to_numpy(), 'thermometer': states['thermometer'].to_numpy(),
+             'datetime': states['datetime'].to_numpy()}
+    df = make_frame(arrays, len(states))
+    assert_shared(df, arrays)
+    # Late rows are appended to such frames, see datastore.MachineStore.
+    assert len(pd.concat([df, df.iloc[-1:].copy()], ignore_index=True)) == 4